@@ -0,0 +1,245 @@
+import asyncio
+import itertools
+import json
+import logging
+
+from supervisor import RestartPolicy
+
+""" asyncio client for the WebAPI tcp protocol.
+
+    async with InhibitorClient("192.168.1.10") as client:
+        print(client.state["inhibiting"])
+        await client.command(inhibit=True, override=True)
+        async for state in client.subscribe():
+            print(state["inhibited_by"])
+
+    Messages are json objects terminated by \\n\\r. The client sends a handshake (or a renew with the token of the
+    previous connection after reconnecting) and the server answers with new_conn and a state_update. After that the
+    server pushes a state_update whenever the state changes. Requests don't have to wait for the previous response,
+    command and history replies are matched to their request with request_id.
+"""
+
+DELIMITER = b"\n\r"
+
+
+class Subscription:
+    """Async iterator over the messages of one type, if the consumer falls behind the oldest messages are dropped
+    (for state updates only the latest one matters)"""
+
+    def __init__(self, client: "InhibitorClient", msg_type: str, maxsize: int):
+        self.client = client
+        self.msg_type = msg_type
+        self.queue = asyncio.Queue(maxsize)
+
+    def _push(self, message):
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(message)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> dict:
+        message = await self.queue.get()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    def close(self):
+        if self in self.client.subscriptions:
+            self.client.subscriptions.remove(self)
+        self._push(None)
+
+
+class InhibitorClient:
+    """Connection to a qbtInhibitor WebAPI that reconnects on its own, state always holds the latest state_update"""
+
+    reconnect_policy = RestartPolicy(base_delay=0.5, max_delay=30)
+
+    def __init__(self, host: str, port: int = 47675, alt_port: int = 47676, reconnect: bool = True,
+                 timeout: float = 10):
+        self.host = host
+        self.ports = (port, alt_port)  # The server falls back to alt_port if port is taken
+        self.reconnect = reconnect
+        self.timeout = timeout  # How long a request waits for its response
+
+        self.token = None
+        self.state = {}  # The latest state_update from the server
+        self.connected = asyncio.Event()
+        self.subscriptions = []
+
+        self._reader = None
+        self._writer = None
+        self._write_lock = asyncio.Lock()
+        self._request_ids = itertools.count(1)
+        self._pending = {}  # request_id -> (future, message), resent if the connection drops before the reply
+        self._refresh_waiters = []
+        self._read_task = None
+        self._closing = False
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def _open(self):
+        last_error = None
+        for port in self.ports:
+            try:
+                return await asyncio.wait_for(asyncio.open_connection(self.host, port), self.timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                last_error = e
+        raise ConnectionError(f"Failed to connect to {self.host}: {last_error}")
+
+    async def _handshake(self):
+        reader, writer = await self._open()
+        try:
+            hello = {"msg_type": "renew", "token": self.token} if self.token else {"msg_type": "handshake"}
+            writer.write(json.dumps(hello).encode("utf-8") + DELIMITER)
+            await writer.drain()
+            reply = json.loads(await asyncio.wait_for(reader.readuntil(DELIMITER), self.timeout))
+            if not isinstance(reply, dict) or reply.get("msg_type") != "new_conn":
+                raise ConnectionError(f"Unexpected handshake reply {reply}")
+        except BaseException:
+            writer.close()
+            raise
+        self._reader, self._writer = reader, writer
+        self.token = reply["token"]
+        logging.info(f"Connected to inhibitor api at {self.host} with token {self.token}")
+
+    async def connect(self):
+        """Connect and wait for the first state update, so state is filled in when this returns"""
+        self._closing = False
+        await self._handshake()
+        waiter = asyncio.get_event_loop().create_future()
+        self._refresh_waiters.append(waiter)
+        self._read_task = asyncio.create_task(self._read_loop(), name="InhibitorClient: Reader")
+        self.connected.set()
+        await asyncio.wait_for(waiter, self.timeout)
+
+    async def close(self):
+        self._closing = True
+        self.connected.clear()
+        if self._read_task is not None and self._read_task is not asyncio.current_task():
+            self._read_task.cancel()
+            await asyncio.gather(self._read_task, return_exceptions=True)
+        if self._writer is not None:
+            self._writer.close()
+        for future, _ in self._pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Client closed"))
+        self._pending = {}
+        for waiter in self._refresh_waiters:
+            if not waiter.done():
+                waiter.set_exception(ConnectionError("Client closed"))
+        self._refresh_waiters = []
+        for subscription in list(self.subscriptions):
+            subscription.close()
+
+    async def _read_loop(self):
+        while not self._closing:
+            try:
+                message = json.loads(await self._reader.readuntil(DELIMITER))
+                if not isinstance(message, dict):
+                    raise ValueError(f"Unexpected message {message}")
+            except Exception as e:
+                # Besides a dropped connection this is a line that isn't json (something else answering on the
+                # port) or one longer than the stream limit, either way the stream can't be trusted any more
+                if self._closing:
+                    return
+                logging.warning(f"Lost connection to inhibitor api at {self.host}: {e!r}")
+                self.connected.clear()
+                self._writer.close()
+                if not self.reconnect:
+                    await self.close()
+                    return
+                await self._reconnect()
+                continue
+            self._dispatch(message)
+
+    async def _reconnect(self):
+        attempt = 0
+        while not self._closing:
+            delay = self.reconnect_policy.delay(attempt)
+            await asyncio.sleep(delay)
+            try:
+                await self._handshake()
+                # Requests that were waiting for a reply when the connection dropped are sent again
+                for _, message in list(self._pending.values()):
+                    await self._send(message)
+            except Exception as e:
+                attempt += 1
+                logging.warning(f"Failed to reconnect to inhibitor api at {self.host}, retrying: {e!r}")
+                if self._writer is not None:
+                    self._writer.close()
+                continue
+            self.connected.set()
+            return
+
+    def _dispatch(self, message: dict):
+        msg_type = message.get("msg_type")
+        if msg_type == "state_update":
+            self.state = message
+            waiters, self._refresh_waiters = self._refresh_waiters, []
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(message)
+        elif message.get("request_id") in self._pending:
+            future, _ = self._pending.pop(message["request_id"])
+            if not future.done():
+                if "error" in message:
+                    future.set_exception(RuntimeError(message["error"]))
+                else:
+                    future.set_result(message)
+        for subscription in self.subscriptions:
+            if subscription.msg_type in (msg_type, None):
+                subscription._push(message)
+
+    async def _send(self, message: dict):
+        async with self._write_lock:
+            self._writer.write(json.dumps(message).encode("utf-8") + DELIMITER)
+            await self._writer.drain()
+
+    async def request(self, msg_type: str, **kwargs) -> dict:
+        """Send a request and wait for the reply with the same request_id, any number of requests can be in flight"""
+        await self.connected.wait()
+        request_id = next(self._request_ids)
+        message = dict(kwargs, msg_type=msg_type, request_id=request_id)
+        future = asyncio.get_event_loop().create_future()
+        self._pending[request_id] = (future, message)
+        try:
+            await self._send(message)
+        except OSError:
+            pass  # The reader notices the dropped connection and resends the request once it has reconnected
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def refresh(self) -> dict:
+        """Ask for the current state, returns the next state update"""
+        await self.connected.wait()
+        waiter = asyncio.get_event_loop().create_future()
+        self._refresh_waiters.append(waiter)
+        await self._send({"msg_type": "refresh"})
+        return await asyncio.wait_for(waiter, self.timeout)
+
+    async def command(self, inhibit: bool, override: bool) -> dict:
+        """Ask the inhibitor to inhibit or not, returns the command_ack, applied_seq tells which change applied it"""
+        return await self.request("command", inhibit=inhibit, override=override)
+
+    async def history(self, start: float, end: float, bucket: float = None) -> dict:
+        return await self.request("history", start=start, end=end, bucket=bucket)
+
+    async def update_response(self, accept: bool):
+        """Answer a new_version message"""
+        await self.connected.wait()
+        await self._send({"msg_type": "sys_command", "command": "pref_update" if accept else "deny_update"})
+
+    def subscribe(self, msg_type: str = "state_update", maxsize: int = 16) -> Subscription:
+        """Iterate over the messages of a type as they arrive, None subscribes to every message"""
+        subscription = Subscription(self, msg_type, maxsize)
+        self.subscriptions.append(subscription)
+        return subscription
@@ -1,16 +1,14 @@
-import asyncio
 import json
 import logging
 import os
 import pathlib
-import traceback
 import logging
 
 import aiohttp
 
-installed_dir = os.path.dirname(os.path.realpath(__file__))
+from scheduler import Scheduler
 
-logging.getLogger(__name__).setLevel(logging.DEBUG)
+installed_dir = os.path.dirname(os.path.realpath(__file__))
 
 
 def cleanup():
@@ -23,6 +21,8 @@ def cleanup():
 
 class GithubUpdater:
 
+    check_interval = 240
+
     def __init__(self, owner: str, repo: str, restart_callback=None,
                  update_available_callback=None):
         self.repo = repo
@@ -50,35 +50,34 @@ class GithubUpdater:
         """Returns the installed version"""
         return self.get_installed_version()
 
-    async def run(self):
+    async def check(self):
+        """Scheduled job, checks github for a newer release"""
+        logging.debug("Checking github for updates")
+        try:
+            latest_release = await self._get_latest_release()
+            if latest_release is None:
+                logging.error("Failed to get latest release")
+                return
+
+            if "tag_name" not in latest_release:
+                logging.error("No latest release tag found")
+                return
+
+            if latest_release["tag_name"] != self.get_installed_version():
+                logging.info(f"New version available: {latest_release['tag_name']}")
+                self.new_version_available = True
+                if self.on_update_available_callback is not None:
+                    current_version = self.get_installed_version()
+                    await self.on_update_available_callback(newest=latest_release["tag_name"],
+                                                            current=current_version)
+            else:
+                self.new_version_available = False
+        except Exception as e:
+            logging.error(f"Failed to check for updates: {e}", exc_info=True)
+
+    async def run(self, scheduler: Scheduler):
         logging.debug("Starting auto update check")
-        while True:
-            try:
-                logging.debug("Checking github for updates")
-                latest_release = await self._get_latest_release()
-                if latest_release is None:
-                    logging.error("Failed to get latest release")
-                    await asyncio.sleep(5)
-                    continue
-
-                if "tag_name" not in latest_release:
-                    logging.error("No latest release tag found")
-                    await asyncio.sleep(5)
-                    continue
-
-                if latest_release["tag_name"] != self.get_installed_version():
-                    logging.info(f"New version available: {latest_release['tag_name']}")
-                    self.new_version_available = True
-                    if self.on_update_available_callback is not None:
-                        current_version = self.get_installed_version()
-                        await self.on_update_available_callback(newest=latest_release["tag_name"],
-                                                                current=current_version)
-                else:
-                    self.new_version_available = False
-            except Exception as e:
-                logging.error(f"Failed to check for updates: {e}\n{traceback.format_exc()}")
-            finally:
-                await asyncio.sleep(240)
+        await scheduler.every("updater", self.check, self.check_interval, jitter=30, cost=10)
 
     async def make_recovery_shell_script(self):
         """Creates a shell script that can be used to restore the old version"""
@@ -137,4 +136,4 @@ class GithubUpdater:
             if self.restart_callback is not None:
                 await self.restart_callback()
         except Exception as e:
-            logging.error(f"Failed to update: {e}\n{traceback.format_exc()}")
\ No newline at end of file
+            logging.error(f"Failed to update: {e}", exc_info=True)
\ No newline at end of file
@@ -0,0 +1,104 @@
+import argparse
+import asyncio
+import json
+import logging
+import statistics
+import time
+
+from api_client import InhibitorClient
+from helpers import APIInhibitor, InhibitHolder
+from scheduler import Scheduler
+from web_api import WebAPI
+
+""" Measures the api round trip latency and request throughput with InhibitorClient.
+
+    Without --host a WebAPI is started on localhost with the rate limit raised so it doesn't cap the results,
+    with --host the benchmark runs against a running inhibitor (and its rate limit).
+
+    Usage: python benchmark_api.py --requests 2000 --pipeline 32 --clients 4
+"""
+
+
+async def latency(client: InhibitorClient, requests: int) -> list:
+    """One request at a time, in milliseconds"""
+    samples = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        await client.history(0, 0)
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+async def throughput(client: InhibitorClient, requests: int, pipeline: int) -> int:
+    """Keep pipeline requests in flight until requests have been answered"""
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            await client.history(0, 0)
+
+    await asyncio.gather(*(worker() for _ in range(pipeline)))
+    return requests
+
+
+async def benchmark(host: str, port: int, requests: int, pipeline: int, clients: int) -> dict:
+    server = None
+    scheduler = None
+    if host is None:
+        host = "127.0.0.1"
+        holder = InhibitHolder()
+        source = APIInhibitor()
+
+        async def history_query(start, end, bucket=None):
+            return {"records": 0}
+
+        source.service_history_query = history_query
+        holder.append(source)
+        scheduler = Scheduler()
+        server = asyncio.create_task(WebAPI(host, port, port + 1, source, scheduler=scheduler,
+                                            message_rate=1e9, message_burst=10 ** 9).run())
+        await asyncio.sleep(0.1)
+
+    connections = [InhibitorClient(host, port, reconnect=False) for _ in range(clients)]
+    for client in connections:
+        await client.connect()
+    try:
+        samples = await latency(connections[0], requests)
+        start = time.perf_counter()
+        total = sum(await asyncio.gather(*(throughput(client, requests, pipeline) for client in connections)))
+        elapsed = time.perf_counter() - start
+    finally:
+        for client in connections:
+            await client.close()
+        if server is not None:
+            scheduler.shutdown()
+            await server
+
+    samples.sort()
+    return {
+        "latency_ms": {"mean": statistics.mean(samples), "p50": samples[len(samples) // 2],
+                       "p99": samples[min(len(samples) - 1, int(len(samples) * 0.99))], "max": samples[-1]},
+        "requests_per_second": total / elapsed,
+        "requests": total,
+        "pipeline": pipeline,
+        "clients": clients,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the inhibitor api")
+    parser.add_argument("--host", help="Benchmark a running inhibitor instead of a local server")
+    parser.add_argument("--port", type=int, default=47675)
+    parser.add_argument("--requests", type=int, default=1000, help="Requests per client")
+    parser.add_argument("--pipeline", type=int, default=16, help="Requests in flight per client")
+    parser.add_argument("--clients", type=int, default=1)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    report = asyncio.run(benchmark(args.host, args.port, args.requests, args.pipeline, args.clients))
+    print(json.dumps(report, indent=4))
+
+
+if __name__ == "__main__":
+    main()
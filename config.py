@@ -0,0 +1,192 @@
+import asyncio
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import struct
+
+from detector import load_detector_class
+from scheduler import Scheduler
+
+# Values used when config.json doesn't set them
+defaults = {
+    "api_port": 47675,
+    "api_alt_port": 47676,
+    "decision_interval": 5,
+    "history": {},
+    "logging": {},  # Options for log_pipeline.setup_logging
+    "detector_worker": False,  # Run the detectors in a separate process, see detector_worker.py
+}
+
+throttle_modes = ("global", "upload_limit", "pause")
+
+
+def normalize_config(raw: dict) -> dict:
+    """Fill in the defaults and turn the single instance qbt_*/plex_* keys into the qbt_instances and detectors
+    lists, the rest of the inhibitor only deals with the normalized form"""
+    config = dict(defaults)
+    config.update(raw)
+    if not config.get("qbt_instances"):
+        config["qbt_instances"] = [{"name": "qbittorrent", "url": raw.get("qbt_url"), "user": raw.get("qbt_user"),
+                                    "password": raw.get("qbt_password")}]
+    config["qbt_instances"] = [dict(instance, name=instance.get("name", instance.get("url")))
+                               for instance in config["qbt_instances"]]
+    if not config.get("detectors"):
+        config["detectors"] = [{"type": "plex", "name": "plex", "url": raw.get("plex_url"),
+                                "token": raw.get("plex_token")},
+                               {"type": "net", "name": "net", "interface": "wg0", "threshold": 0.5}]
+    config["detectors"] = [dict(detector, name=detector.get("name", detector.get("type")))
+                           for detector in config["detectors"]]
+    return config
+
+
+def validate_config(config: dict):
+    """Raise ValueError describing the first problem found in a normalized config"""
+    if not isinstance(config.get("api_ip"), str):
+        raise ValueError("api_ip must be set")
+    for key in ("api_port", "api_alt_port"):
+        if not isinstance(config[key], int) or not 0 < config[key] < 65536:
+            raise ValueError(f"{key} must be a port number")
+    if not isinstance(config["decision_interval"], (int, float)) or config["decision_interval"] <= 0:
+        raise ValueError("decision_interval must be a positive number")
+    if config["logging"].get("format", "json") not in ("json", "text"):
+        raise ValueError("logging format must be json or text")
+    if not isinstance(logging.getLevelName(config["logging"].get("level", "INFO")), int):
+        raise ValueError(f"Unknown logging level {config['logging']['level']}")
+
+    names = set()
+    for instance in config["qbt_instances"]:
+        for key in ("url", "user", "password"):
+            if not instance.get(key):
+                raise ValueError(f"qbittorrent instance {instance.get('name')} is missing {key}")
+        if instance["name"] in names:
+            raise ValueError(f"qbittorrent instance {instance['name']} is configured more than once")
+        if instance.get("throttle_mode", "global") not in throttle_modes:
+            raise ValueError(f"qbittorrent instance {instance['name']} has an unknown throttle_mode")
+        names.add(instance["name"])
+
+    names = set()
+    for detector in config["detectors"]:
+        if "type" not in detector:
+            raise ValueError(f"Detector {detector.get('name')} has no type")
+        if detector["name"] in names:
+            raise ValueError(f"Detector {detector['name']} is configured more than once")
+        load_detector_class(detector["type"]).validate(detector)
+        names.add(detector["name"])
+
+
+def load_config(path: str) -> dict:
+    with open(path) as config_file:
+        config = normalize_config(json.load(config_file))
+    validate_config(config)
+    return config
+
+
+class ConfigWatcher:
+    """Calls callback with the new config whenever the config file changes and the new config is valid.
+    Uses inotify on the directory of the file (editors often replace the file instead of writing to it) and falls
+    back to checking the modification time every few seconds where inotify isn't available"""
+
+    IN_CLOSE_WRITE = 0x08
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    EVENT = struct.Struct("iIII")  # wd, mask, cookie, name length
+
+    def __init__(self, path: str, callback, scheduler: Scheduler, debounce: float = 0.5, poll_interval: float = 5):
+        self.path = os.path.abspath(path)
+        self.callback = callback  # Coroutine function called with the new normalized config
+        self.scheduler = scheduler  # Runs the modification time check when inotify isn't available
+        self.debounce = debounce  # Editors can write a file in several steps, wait for them to finish
+        self.poll_interval = poll_interval
+        self._fd = None
+        self._pending = None
+        self._mtime = self._get_mtime()
+        self._task = None
+        self._poll_job = None
+
+    def _get_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def start(self):
+        try:
+            self._start_inotify()
+        except Exception as e:
+            logging.warning(f"inotify is not available ({e}), checking {self.path} every {self.poll_interval}s")
+            self._poll_job = self.scheduler.add("config_watcher", self._poll, self.poll_interval, run_now=False)
+
+    def _start_inotify(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        if libc.inotify_add_watch(fd, os.path.dirname(self.path).encode(), mask) < 0:
+            os.close(fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+        self._fd = fd
+        asyncio.get_event_loop().add_reader(fd, self._on_inotify)
+        logging.info(f"Watching {self.path} for changes")
+
+    def _on_inotify(self):
+        name = os.path.basename(self.path).encode()
+        changed = False
+        while True:
+            try:
+                data = os.read(self._fd, 4096)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                _, _, _, length = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size
+                if data[offset:offset + length].rstrip(b"\0") == name:
+                    changed = True
+                offset += length
+        if changed:
+            self._schedule()
+
+    def _poll(self):
+        mtime = self._get_mtime()
+        if mtime != self._mtime:
+            self._mtime = mtime
+            self._schedule()
+
+    def _schedule(self):
+        if self._pending is not None:
+            self._pending.cancel()
+        self._pending = asyncio.get_event_loop().call_later(self.debounce, self._reload)
+
+    def _reload(self):
+        self._pending = None
+        if self._task is not None and not self._task.done():
+            # A reload is still being applied, try again once it is done
+            self._schedule()
+            return
+        try:
+            config = load_config(self.path)
+        except Exception as e:
+            logging.error(f"Not reloading {self.path}, the new config is invalid: {e}")
+            return
+        logging.info(f"{self.path} changed, reloading")
+        self._task = asyncio.get_event_loop().create_task(self._apply(config), name="config_reload")
+
+    async def _apply(self, config: dict):
+        try:
+            await self.callback(config)
+        except Exception as e:
+            logging.error(f"Failed to apply the new config: {e}", exc_info=True)
+
+    def stop(self):
+        if self._pending is not None:
+            self._pending.cancel()
+        if self._fd is not None:
+            asyncio.get_event_loop().remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
+        if self._poll_job is not None:
+            self.scheduler.remove(self._poll_job)
+            self._poll_job = None
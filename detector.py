@@ -0,0 +1,143 @@
+import importlib
+import logging
+
+import netifaces
+
+from helpers import InhibitSource
+from scheduler import Scheduler
+from supervisor import RestartPolicy, Supervisor
+
+# Detector types that can be used in the config, the modules are only imported when a detector of that type is
+# configured so the dependencies of unused detectors (plexapi for example) don't have to be installed.
+# A type can also be given in the config as "module:ClassName" to load a detector that isn't listed here
+detector_types = {
+    "plex": "plex_detector:PlexDetector",
+    "net": "net_detector:NetDetector",
+    "jellyfin": "media_detector:JellyfinDetector",
+    "emby": "media_detector:EmbyDetector",
+}
+
+
+def load_detector_class(detector_type: str):
+    """Resolve the type field of a detector config to a Detector subclass"""
+    path = detector_types.get(detector_type, detector_type)
+    if ":" not in path:
+        raise ValueError(f"Unknown detector type {detector_type}")
+    module_name, class_name = path.split(":", 1)
+    detector_class = getattr(importlib.import_module(module_name), class_name)
+    if not issubclass(detector_class, Detector):
+        raise ValueError(f"{path} is not a Detector")
+    return detector_class
+
+
+def get_local_subnets():
+    """
+    Gets the /24 subnets of all the ip addresses that can be bound to, players on these subnets are on the same
+    network as the media server and don't use the uplink
+    """
+    subnets = []
+    for interface in netifaces.interfaces():
+        try:
+            if netifaces.AF_INET in netifaces.ifaddresses(interface):
+                for link in netifaces.ifaddresses(interface)[netifaces.AF_INET]:
+                    if link["addr"] != "":
+                        logging.debug(f"Found interface {link['addr']}")
+                        subnets.append(".".join(link["addr"].split(".")[0:3]))
+        except Exception as e:
+            logging.debug(f"Error getting interface {interface}: {e}")
+    return subnets
+
+
+class DetectorContext:
+    """Resources shared by every detector, the http pools are created the first time a detector asks for them"""
+
+    def __init__(self, scheduler: Scheduler, supervisor: Supervisor):
+        self.scheduler = scheduler
+        self.supervisor = supervisor
+        self._http_session = None
+        self._requests_session = None
+
+    @property
+    def http_session(self):
+        """aiohttp session shared by the detectors that talk to http apis"""
+        if self._http_session is None or self._http_session.closed:
+            import aiohttp
+            self._http_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=16))
+        return self._http_session
+
+    @property
+    def requests_session(self):
+        """requests session shared by the detectors built on blocking libraries (plexapi)"""
+        if self._requests_session is None:
+            import requests
+            self._requests_session = requests.Session()
+        return self._requests_session
+
+    async def close(self):
+        if self._http_session is not None:
+            await self._http_session.close()
+        if self._requests_session is not None:
+            self._requests_session.close()
+
+
+class Detector:
+    """Base class for detector plugins.
+    A detector is built from one entry of the detectors list in the config, it owns an InhibitSource of type
+    source_class and sets should_inhibit and connected on it from poll(), which is run by the scheduler"""
+
+    source_class = InhibitSource
+    restart_policy = RestartPolicy()
+
+    interval = 5  # Default poll interval, can be overridden with "interval" in the config
+    jitter = 0.5
+    cost = 1
+
+    required = ()  # Config keys the detector can't run without
+    interval_fields = ("interval",)  # Class attributes that can be overridden from the config
+    tunable = ("interval",)  # Config keys that retune() can apply without restarting the detector
+
+    def __init__(self, name: str, config: dict, interface_class: InhibitSource, context: DetectorContext):
+        self.name = name
+        self.config = config
+        self.interface_class = interface_class
+        self.context = context
+        self.scheduler = context.scheduler
+        self._load_intervals(config)
+
+    def _load_intervals(self, config: dict):
+        for field in self.interval_fields:
+            setattr(self, field, config.get(field, getattr(type(self), field)))
+
+    @classmethod
+    def validate(cls, config: dict):
+        """Raise ValueError if the config can't be used for this detector"""
+        for key in cls.required:
+            if key not in config:
+                raise ValueError(f"Detector {config.get('name')} is missing {key}")
+        for field in cls.interval_fields:
+            value = config.get(field, getattr(cls, field))
+            if not isinstance(value, (int, float)) or value <= 0:
+                raise ValueError(f"Detector {config.get('name')} has an invalid {field}: {value}")
+
+    def retune(self, config: dict) -> bool:
+        """Apply a changed config without restarting the detector, returns False if the change needs a restart"""
+        changed = {key for key in set(config) | set(self.config) if config.get(key) != self.config.get(key)}
+        if not changed <= set(self.tunable):
+            return False
+        self.config = config
+        self._load_intervals(config)
+        job = self.scheduler.jobs.get(self.name)
+        if job is not None:
+            job.set_interval(self.interval)
+        return True
+
+    async def poll(self):
+        """Check the upstream and update the source, may return the interval until the next poll"""
+        raise NotImplementedError
+
+    async def run(self):
+        await self.scheduler.every(self.name, self.poll, self.interval, jitter=self.jitter, cost=self.cost)
+
+    def health(self) -> dict:
+        """Connection health reported to the api clients"""
+        return {"connected": self.interface_class.connected}
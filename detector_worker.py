@@ -0,0 +1,261 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import struct
+import time
+from multiprocessing import shared_memory
+
+from detector import DetectorContext, load_detector_class
+from helpers import InhibitHolder
+from log_pipeline import setup_logging, stop_logging
+from scheduler import Scheduler
+from supervisor import RestartPolicy, Supervisor
+
+""" Runs the detectors in a separate process so plexapi's xml parsing and the psutil sampling don't compete with
+    the api for the main interpreter.
+
+    The worker publishes what the detectors found into a shared memory block the main process reads in place:
+    header: magic (4s), format version (H), slot count (H), heartbeat (d, unix time, updated every second by the
+            worker), worker pid (Q)
+    slot, one per detector in config order: sequence (I), should_inhibit (B), connected (B, 0 no, 1 yes,
+            2 unknown), sessions (H), upload (f, mbit/s), updated (d, unix time of the last poll), padding
+    Each slot has a single writer. The sequence is odd while the worker is writing the slot, a reader retries until
+    it sees the same even sequence before and after reading. A worker that dies halfway through a write leaves the
+    sequence odd for good, so the reader gives up after a few tries and treats the slot as stale.
+"""
+
+HEADER = struct.Struct("<4sHHdQ")
+SLOT = struct.Struct("<IBBHfd4x")
+SEQUENCE = struct.Struct("<I")
+MAGIC = b"QBTW"
+FORMAT_VERSION = 1
+
+CONNECTED_UNKNOWN = 2
+READ_RETRIES = 100
+
+
+class SharedBlock:
+    """The shared memory block, created by the main process and attached to by the worker"""
+
+    def __init__(self, slots: int = None, name: str = None):
+        if name is None:
+            self.memory = shared_memory.SharedMemory(create=True, size=HEADER.size + slots * SLOT.size)
+            HEADER.pack_into(self.memory.buf, 0, MAGIC, FORMAT_VERSION, slots, 0, 0)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        magic, version, self.slots, _, _ = HEADER.unpack_from(self.memory.buf, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"Shared memory block {self.memory.name} has an unknown layout")
+        self.owner = name is None
+
+    @property
+    def name(self) -> str:
+        return self.memory.name
+
+    def _offset(self, index: int) -> int:
+        if not 0 <= index < self.slots:
+            raise IndexError(f"Slot {index} is out of range")
+        return HEADER.size + index * SLOT.size
+
+    def beat(self):
+        HEADER.pack_into(self.memory.buf, 0, MAGIC, FORMAT_VERSION, self.slots, time.time(), os.getpid())
+
+    def heartbeat(self) -> float:
+        return HEADER.unpack_from(self.memory.buf, 0)[3]
+
+    def write(self, index: int, should_inhibit: bool, connected, sessions: int, upload: float):
+        offset = self._offset(index)
+        sequence = SEQUENCE.unpack_from(self.memory.buf, offset)[0]
+        SEQUENCE.pack_into(self.memory.buf, offset, sequence + 1)
+        SLOT.pack_into(self.memory.buf, offset, sequence + 1, bool(should_inhibit),
+                       CONNECTED_UNKNOWN if connected is None else bool(connected), min(sessions, 0xFFFF), upload,
+                       time.time())
+        SEQUENCE.pack_into(self.memory.buf, offset, sequence + 2)
+
+    def read(self, index: int):
+        """(should_inhibit, connected, sessions, upload, updated) of a slot, None if no consistent copy could be
+        read (the slot is being written or the writer died in the middle of a write)"""
+        offset = self._offset(index)
+        for _ in range(READ_RETRIES):
+            sequence, should_inhibit, connected, sessions, upload, updated = SLOT.unpack_from(self.memory.buf, offset)
+            if sequence % 2 == 0 and SEQUENCE.unpack_from(self.memory.buf, offset)[0] == sequence:
+                return (bool(should_inhibit), None if connected == CONNECTED_UNKNOWN else bool(connected), sessions,
+                        upload, updated)
+        return None
+
+    def close(self):
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+def _worker_main(block_name: str, configs: list, logging_config: dict, log_level: int):
+    """Entry point of the worker process, logs with the same settings as the inhibitor"""
+    listener = setup_logging(**logging_config)
+    logging.getLogger().setLevel(log_level)  # The level may have been changed by a config reload since the start
+    try:
+        asyncio.run(_worker(block_name, configs))
+    finally:
+        stop_logging(listener)
+
+
+async def _worker(block_name: str, configs: list):
+    block = SharedBlock(name=block_name)
+    scheduler = Scheduler()
+    supervisor = Supervisor()
+    context = DetectorContext(scheduler, supervisor)
+    holder = InhibitHolder()
+    parent = os.getppid()
+    # terminate() from the inhibitor stops the worker cleanly so the pending log summaries are written
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, scheduler.shutdown)
+
+    def start_detector(index: int, config: dict, detector_class):
+        if holder.get_source(config["name"]) is not None:
+            holder.remove_by_name(config["name"])
+        source = detector_class.source_class(config["name"])
+        holder.append(source)
+        detector = detector_class(config["name"], config, source, context)
+        poll = detector.poll
+
+        async def publishing_poll():
+            try:
+                return await poll()
+            finally:
+                block.write(index, source.should_inhibit, source.connected, getattr(source, "total_sessions", 0),
+                            getattr(source, "upload", 0))
+
+        detector.poll = publishing_poll
+        return detector.run()
+
+    for index, config in enumerate(configs):
+        detector_class = load_detector_class(config["type"])
+        logging.info(f"Starting {detector_class.__name__} {config['name']} in the worker")
+        supervisor.add(config["name"], lambda index=index, config=config, detector_class=detector_class:
+                       start_detector(index, config, detector_class), detector_class.restart_policy)
+
+    async def heartbeat():
+        if os.getppid() != parent:
+            logging.warning("The inhibitor exited, stopping the detector worker")
+            scheduler.shutdown()
+            return
+        block.beat()
+
+    try:
+        await scheduler.every("heartbeat", heartbeat, 1)
+    finally:
+        await supervisor.stop(timeout=5)
+        await context.close()
+        block.close()
+
+
+class DetectorWorker:
+    """Runs the configured detectors in a worker process and mirrors their results onto sources in the main
+    process, the worker is started again (with a fresh shared block) whenever it dies or stops answering.
+    The shared block is read by the decision job (see read), the worker itself only adds a slow liveness check to
+    the main process' scheduler"""
+
+    restart_policy = RestartPolicy(base_delay=1, max_delay=60)
+
+    check_interval = 10  # How often the worker is checked for being alive and sending heartbeats
+    stale_after = 30  # Seconds without a heartbeat before the worker is considered hung
+
+    def __init__(self, configs: list, holder: InhibitHolder, scheduler: Scheduler, logging_config: dict = None):
+        self.configs = configs
+        self.logging_config = logging_config or {}  # Options for log_pipeline.setup_logging in the worker
+        self.holder = holder
+        self.scheduler = scheduler
+        self.sources = {}  # Name -> the source in the main process that mirrors the worker's detector
+        self.process = None
+        self.block = None
+        self.started = None
+        self.restarts = -1
+        self._stale = set()  # Names of the detectors whose slot couldn't be read last time, warned about once
+
+    def _add_sources(self):
+        for config in self.configs:
+            if self.holder.get_source(config["name"]) is not None:
+                self.holder.remove_by_name(config["name"])
+            source = load_detector_class(config["type"]).source_class(config["name"])
+            self.sources[config["name"]] = source
+            self.holder.append(source)
+
+    def remove_sources(self):
+        for name in self.sources:
+            if self.holder.get_source(name) is not None:
+                self.holder.remove_by_name(name)
+        self.sources = {}
+
+    def read(self):
+        """Copy what the worker published onto the sources, called right before every decision"""
+        if self.block is None:
+            return  # The worker is being restarted, the sources were reset by _stop
+        for index, config in enumerate(self.configs):
+            slot = self.block.read(index)
+            if slot is None:
+                if config["name"] not in self._stale:
+                    logging.warning(f"Detector {config['name']} is being written by the worker or its slot is "
+                                    f"stale, keeping its last state")
+                    self._stale.add(config["name"])
+                continue
+            self._stale.discard(config["name"])
+            should_inhibit, connected, sessions, upload, updated = slot
+            if not updated:
+                continue  # The detector hasn't polled yet
+            source = self.sources[config["name"]]
+            source.should_inhibit = should_inhibit
+            source.connected = connected
+            if hasattr(source, "total_sessions"):
+                source.total_sessions = sessions
+            if hasattr(source, "upload"):
+                source.upload = upload
+
+    async def run(self):
+        """Supervised task, raises if the worker dies so the supervisor starts a new one after its backoff"""
+        self._add_sources()
+
+        async def check():
+            if not self.process.is_alive():
+                raise RuntimeError(f"Detector worker exited with code {self.process.exitcode}")
+            last_beat = self.block.heartbeat() or self.started
+            if time.time() - last_beat > self.stale_after:
+                raise RuntimeError(f"Detector worker hasn't sent a heartbeat for {time.time() - last_beat:.0f}s")
+
+        try:
+            self.block = SharedBlock(len(self.configs))
+            self.process = multiprocessing.get_context("spawn").Process(
+                target=_worker_main, args=(self.block.name, self.configs, self.logging_config,
+                                           logging.getLogger().getEffectiveLevel()),
+                name="detector worker", daemon=True)
+            self.process.start()
+            self.started = time.time()
+            self.restarts += 1
+            logging.info(f"Started detector worker {self.process.pid} for {len(self.configs)} detectors")
+            await self.scheduler.every("detector_worker", check, self.check_interval, jitter=2, cost=1)
+        finally:
+            await self._stop()
+
+    async def _stop(self):
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+            await asyncio.to_thread(self.process.join, 5)
+            if self.process.is_alive():
+                self.process.kill()
+        for source in self.sources.values():
+            source.connected = False
+            source.should_inhibit = False
+        if self.block is not None:
+            self.block.close()
+            self.block = None
+        self._stale = set()
+
+    def health(self) -> dict:
+        """Health of every detector in the worker, reported to the api clients"""
+        health = {}
+        for name, source in self.sources.items():
+            health[name] = {"connected": source.connected, "worker_pid": self.process.pid if self.process else None,
+                            "worker_restarts": max(self.restarts, 0)}
+            if hasattr(source, "total_sessions"):
+                health[name]["sessions"] = source.total_sessions
+        return health
@@ -3,98 +3,277 @@ import json
 import typing
 
 
+class SystemState(typing.NamedTuple):
+    """State set by the inhibitor rather than the sources, stored once in the holder and shared by every source"""
+    inhibiting: bool = False  # This is a flag to indicate if we are currently inhibiting or not
+    inhibited_by: tuple = ()  # This is a list of sources that are inhibiting us
+    overridden: bool = False  # This is a flag to indicate if we are currently overridden or not
+    overridden_by: tuple = ()  # This is a list of sources that are overriding us
+    qbt_connection: bool = None  # Indicates if the inhibitor is connected to every qbt instance
+    qbt_instances: dict = {}  # Connection status of each qbt instance by name
+    plex_connection: bool = None  # Indicates if the inhibitor is connected to plex
+    net_connection: bool = None  # Indicates if the inhibitor is connected to wireguard
+    detectors: dict = {}  # Connection health reported by each detector by name
+    # Restart counts and circuit breaker states of the supervised tasks. Counters that change on every tick (the
+    # scheduler stats) are kept out of the state so the version only changes when something actually happened
+    services: dict = {}
+    message: str = ""  # This is a message that is displayed to the user
+
+
+class SourceState(typing.NamedTuple):
+    """The decision relevant flags of a single source at the time a snapshot was taken"""
+    name: str
+    label: str  # str() of the source, what it is called in inhibited_by
+    should_inhibit: bool
+    is_override: bool
+    sessions: int  # Remote sessions of a media source, 0 for the other sources
+
+
+class Snapshot(typing.NamedTuple):
+    """Immutable view of the holder, a new one is only built after the version changes"""
+    version: int
+    state: SystemState
+    sources: tuple  # SourceState for every source in the order they were added
+
+
+def _shared_field(name: str):
+    """Read only property that reads a field of the shared SystemState"""
+    return property(lambda self: getattr(self.system_state, name))
+
+
 class InhibitSource:
 
     def __init__(self, name: str = ""):
         self.name = name
-        self.is_override = False  # This is a flag to indicate that whatever this source will override all other sources
-        self.should_inhibit = False  # This is a flag to indicate if we should inhibit or not
+        self._holder = None  # The InhibitHolder this source has been added to
+        self._is_override = False
+        self._should_inhibit = False
 
+        self.connected = None  # Set by the detector that owns this source, None if it has no upstream
         self.shutdown = False  # This is a flag to indicate to this source that it should shut down
         self.inhibit_event = asyncio.Event()  # This is an event that is called when we change the inhibit state
 
-        # These values are set by the inhibitor not the source
-        self.inhibiting = False  # This is a flag to indicate if we are currently inhibiting or not
-        self.inhibited_by = []  # This is a list of sources that are inhibiting us
-        self.overridden = False  # This is a flag to indicate if we are currently overridden or not
-        self.overridden_by = []  # This is a list of sources that are overriding us
-        self.qbt_connection = None   # Indicates if the inhibitor is connected to qbt
-        self.plex_connection = None  # Indicates if the inhibitor is connected to plex
-        self.net_connection = None   # Indicates if the inhibitor is connected to wireguard
-        self.message = ""  # This is a message that is displayed to the user
-
-    def update_state(self, **kwargs):
-        """Update locals via kwargs"""
-        for key, value in kwargs.items():
-            setattr(self, key, value)
+    @property
+    def is_override(self):
+        """This is a flag to indicate that whatever this source will override all other sources"""
+        return self._is_override
+
+    @is_override.setter
+    def is_override(self, value: bool):
+        if value != self._is_override:
+            self._is_override = value
+            if self._holder is not None:
+                self._holder.invalidate()
+
+    @property
+    def should_inhibit(self):
+        """This is a flag to indicate if we should inhibit or not"""
+        return self._should_inhibit
+
+    @should_inhibit.setter
+    def should_inhibit(self, value: bool):
+        if value != self._should_inhibit:
+            self._should_inhibit = value
+            if self._holder is not None:
+                self._holder.invalidate()
+
+    @property
+    def system_state(self) -> SystemState:
+        """These values are set by the inhibitor not the source"""
+        if self._holder is None:
+            return _default_state
+        return self._holder.state
+
+    @property
+    def state_version(self) -> int:
+        """Version of the holder this source belongs to, increases on every change"""
+        if self._holder is None:
+            return 0
+        return self._holder.version
+
+    inhibiting = _shared_field("inhibiting")
+    inhibited_by = _shared_field("inhibited_by")
+    overridden = _shared_field("overridden")
+    overridden_by = _shared_field("overridden_by")
+    qbt_connection = _shared_field("qbt_connection")
+    qbt_instances = _shared_field("qbt_instances")
+    plex_connection = _shared_field("plex_connection")
+    net_connection = _shared_field("net_connection")
+    detectors = _shared_field("detectors")
+    services = _shared_field("services")
+    message = _shared_field("message")
+
+
+_default_state = SystemState()
 
 
 class InhibitHolder:
+    """Holds the inhibit sources indexed by name and type along with the shared system state.
+    Every change bumps the version, snapshot() returns the same immutable object until the next change"""
 
     def __init__(self):
-        self.sources = []
+        self.sources = {}  # Name -> source, in the order they were added
+        self.by_type = {}  # Type -> {name: source} for the type of every source and its InhibitSource parents
+        self.state = _default_state
+        self.version = 0
+        self._snapshot = None
 
-    def append(self, source: InhibitSource):
-        self.sources.append(source)
+    def invalidate(self):
+        """Called whenever a source or the state changes"""
+        self.version += 1
+        self._snapshot = None
 
-    def remove_by_name(self, source: str):
-        for source in self.sources:
-            if source.name == source:
-                self.sources.remove(source)
-                return
-        raise ValueError("Source not found")
+    def append(self, source: InhibitSource):
+        if not source.name:
+            source.name = type(source).__name__
+        if source.name in self.sources:
+            raise ValueError(f"Source {source.name} already exists")
+        source._holder = self
+        self.sources[source.name] = source
+        for source_type in type(source).__mro__:
+            if issubclass(source_type, InhibitSource):
+                self.by_type.setdefault(source_type, {})[source.name] = source
+        self.invalidate()
+
+    def _remove(self, source: InhibitSource):
+        del self.sources[source.name]
+        for source_type in type(source).__mro__:
+            if issubclass(source_type, InhibitSource):
+                del self.by_type[source_type][source.name]
+        source._holder = None
+        self.invalidate()
+
+    def remove_by_name(self, name: str):
+        if name not in self.sources:
+            raise ValueError("Source not found")
+        self._remove(self.sources[name])
 
     def remove_by_type(self, source_type: type):
-        for source in self.sources:
-            if isinstance(source, source_type):
-                self.sources.remove(source)
+        for source in list(self.by_type.get(source_type, {}).values()):
+            self._remove(source)
 
     def get_source(self, name: str):
-        for source in self.sources:
-            if source.name == name:
-                return source
-        return None
+        return self.sources.get(name)
 
     def update_state(self, **kwargs):
-        for source in self.sources:
-            source.update_state(**kwargs)
-            source.inhibit_event.set()
+        self.silent_update_state(**kwargs)
+        self.refresh_state()
 
     def refresh_state(self):
-        for source in self.sources:
+        for source in self.sources.values():
             source.inhibit_event.set()
 
     def silent_update_state(self, **kwargs):
-        for source in self.sources:
-            source.update_state(**kwargs)
+        if "inhibited_by" in kwargs:
+            kwargs["inhibited_by"] = tuple(kwargs["inhibited_by"])
+        if "overridden_by" in kwargs:
+            kwargs["overridden_by"] = tuple(kwargs["overridden_by"])
+        state = self.state._replace(**kwargs)
+        if state != self.state:
+            self.state = state
+            self.invalidate()
+
+    def snapshot(self) -> Snapshot:
+        if self._snapshot is None:
+            self._snapshot = Snapshot(self.version, self.state, tuple(
+                SourceState(source.name, str(source), source.should_inhibit, source.is_override,
+                            getattr(source, "total_sessions", 0))
+                for source in self.sources.values()))
+        return self._snapshot
 
     def get_by_type(self, source_type: type):
-        for source in self.sources:
-            if isinstance(source, source_type):
-                return source
-        return None
+        sources = self.by_type.get(source_type)
+        if not sources:
+            return None
+        return next(iter(sources.values()))
+
+    def get_all_by_type(self, source_type: type):
+        return list(self.by_type.get(source_type, {}).values())
 
     def dump_names(self):
-        return [str(source) for source in self.sources]
+        return [str(source) for source in self.sources.values()]
 
     def __iter__(self):
-        return self.sources.__iter__()
-
-
-class PlexInhibitor(InhibitSource):
+        return iter(self.sources.values())
+
+    def __len__(self):
+        return len(self.sources)
+
+
+def decide(snapshot: Snapshot):
+    """The inhibit decision, a source that is overriding wins outright, otherwise any source that wants to inhibit
+    does. Returns should_inhibit, overridden, the str() of the deciding sources and their names"""
+    should_inhibit = False
+    overridden = False
+    sources = []
+    source_names = []
+    for source in snapshot.sources:
+        if source.is_override:
+            should_inhibit = source.should_inhibit
+            sources = [source.label]
+            source_names = [source.name]
+            overridden = True
+            break
+        else:
+            if source.should_inhibit:
+                should_inhibit = True
+                sources.append(source.label)
+                source_names.append(source.name)
+    return should_inhibit, overridden, sources, source_names
+
+
+class MediaInhibitor(InhibitSource):
+    """Source of a media server detector, label is what the source is called in inhibited_by"""
+
+    label = "Media"
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.total_sessions = 0
-        self.connected_to_plex = False
+        self._total_sessions = 0
+        self.connected = False
+
+    @property
+    def total_sessions(self):
+        """Remote sessions seen on the last poll, part of the snapshot through the label"""
+        return self._total_sessions
+
+    @total_sessions.setter
+    def total_sessions(self, value: int):
+        if value != self._total_sessions:
+            self._total_sessions = value
+            if self._holder is not None:
+                self._holder.invalidate()
 
     def __str__(self):
-        return f"Plex({self.total_sessions})"
+        return f"{self.label}({self.total_sessions})"
 
     def __repr__(self):
         return self.__str__()
 
 
+class PlexInhibitor(MediaInhibitor):
+
+    label = "Plex"
+
+    @property
+    def connected_to_plex(self):
+        return self.connected
+
+    @connected_to_plex.setter
+    def connected_to_plex(self, value: bool):
+        self.connected = value
+
+
+class JellyfinInhibitor(MediaInhibitor):
+
+    label = "Jellyfin"
+
+
+class EmbyInhibitor(MediaInhibitor):
+
+    label = "Emby"
+
+
 class WebInhibitor(InhibitSource):
 
     def __init__(self, *args, **kwargs):
@@ -117,6 +296,8 @@ class APIInhibitor(InhibitSource):
         # Callbacks
         self.service_restart_method = None
         self.service_update_response = None
+        self.service_history_query = None
+        self.service_stats = None  # Returns live stats that are added to the state messages but not versioned
 
     def __str__(self):
         return f"API"
@@ -132,7 +313,16 @@ class NetInhibitor(InhibitSource):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.connected_to_net = False
+        self.connected = False
+        self.upload = 0  # Upload rate in mbit/s measured on the last poll
+
+    @property
+    def connected_to_net(self):
+        return self.connected
+
+    @connected_to_net.setter
+    def connected_to_net(self, value: bool):
+        self.connected = value
 
     def __str__(self):
         return f"Net"
@@ -0,0 +1,306 @@
+import bisect
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+try:
+    import numpy
+except ImportError:  # numpy is in requirements.txt, the fallback below is only there so history keeps working
+    numpy = None
+
+""" History file layout:
+    Each segment file starts with a 64 byte header followed by fixed width little endian records.
+    header: magic (4s), format version (H), record size (H), record capacity (I), record count (Q), padding
+    record: time (d, unix seconds), kind (B), inhibiting (B), overridden (B), connections (B, bit 0 qbt, bit 1 plex,
+            bit 2 net), sources (H, bit per source, see sources.json), sessions (H), upload (f, mbit/s), padding
+    Records are appended in time order so a time range is found with a binary search.
+"""
+
+HEADER = struct.Struct("<4sHHIQ44x")
+RECORD = struct.Struct("<dBBBBHHf4x")
+MAGIC = b"QBTH"
+FORMAT_VERSION = 1
+
+SAMPLE = 0  # Periodic sample of the state
+TRANSITION = 1  # The inhibit state changed
+
+CONNECTION_QBT = 1
+CONNECTION_PLEX = 2
+CONNECTION_NET = 4
+
+MAX_SOURCES = 16  # One bit per source in the sources field
+
+if numpy is not None:
+    RECORD_DTYPE = numpy.dtype([("time", "<f8"), ("kind", "u1"), ("inhibiting", "u1"), ("overridden", "u1"),
+                                ("connections", "u1"), ("sources", "<u2"), ("sessions", "<u2"), ("upload", "<f4"),
+                                ("padding", "V4")])
+    assert RECORD_DTYPE.itemsize == RECORD.size
+
+
+class Segment:
+    """A single memory mapped history file"""
+
+    def __init__(self, path: str, capacity: int = None):
+        self.path = path
+        self.start = History.segment_start(os.path.basename(path))
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.write(HEADER.pack(MAGIC, FORMAT_VERSION, RECORD.size, capacity, 0))
+                f.truncate(HEADER.size + capacity * RECORD.size)
+        self.file = open(path, "r+b")
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.readers = 0  # Queries currently reading from the segment, see History._acquire
+        self.retired = False  # Dropped by a rollover, deleted once the last reader is done
+        magic, version, record_size, self.capacity, self.count = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != FORMAT_VERSION or record_size != RECORD.size:
+            self.close()
+            raise ValueError(f"{path} is not a history file this version can read")
+
+    @property
+    def full(self) -> bool:
+        return self.count >= self.capacity
+
+    def append(self, record: tuple):
+        RECORD.pack_into(self.map, HEADER.size + self.count * RECORD.size, *record)
+        self.count += 1
+        HEADER.pack_into(self.map, 0, MAGIC, FORMAT_VERSION, RECORD.size, self.capacity, self.count)
+
+    def time_at(self, index: int) -> float:
+        return struct.unpack_from("<d", self.map, HEADER.size + index * RECORD.size)[0]
+
+    def find(self, timestamp: float, count: int) -> int:
+        """Index of the first record at or after timestamp"""
+        return bisect.bisect_left(_TimeIndex(self), timestamp, 0, count)
+
+    def view(self, first: int, last: int):
+        """The raw bytes of records [first, last), no copy is made"""
+        return memoryview(self.map)[HEADER.size + first * RECORD.size:HEADER.size + last * RECORD.size]
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class _TimeIndex:
+    """Lets bisect search the timestamps of a segment without unpacking the records"""
+
+    def __init__(self, segment: Segment):
+        self.segment = segment
+
+    def __getitem__(self, index: int) -> float:
+        return self.segment.time_at(index)
+
+
+class History:
+    """Append only store of inhibit transitions and periodic state samples, kept in memory mapped segment files
+    that roll over once they are full, only the newest max_segments are kept"""
+
+    def __init__(self, directory: str = "history", segment_records: int = 2 ** 20, max_segments: int = 12,
+                 sample_interval: float = 30):
+        self.directory = directory
+        self.segment_records = segment_records  # 2 ** 20 records is 24MB, or about a year of 30 second samples
+        self.max_segments = max_segments
+        self.sample_interval = sample_interval
+        self.max_gap = sample_interval * 3  # Gaps longer than this (the inhibitor was down) aren't counted
+        os.makedirs(directory, exist_ok=True)
+        if numpy is None:
+            logging.warning("numpy is not installed, history queries fall back to unpacking every record in python "
+                            "which is dozens of times slower, install requirements.txt")
+
+        self.sources_path = os.path.join(directory, "sources.json")
+        self.sources = {}  # Source name -> bit
+        if os.path.exists(self.sources_path):
+            with open(self.sources_path) as f:
+                self.sources = json.load(f)
+
+        self.segments = [Segment(os.path.join(directory, name)) for name in
+                         sorted(os.listdir(directory), key=self.segment_start)
+                         if name.startswith("history-") and name.endswith(".bin")]
+        self.last_sample = 0
+        self.last_inhibiting = None
+        # query() runs in a thread while record() keeps appending, the lock guards the segment list and the reader
+        # counts so a rollover never closes a segment a query is still reading
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def segment_start(name: str) -> float:
+        """Segments are named after the time of their first record in milliseconds"""
+        try:
+            return int(name.split("-")[1].split(".")[0]) / 1000
+        except (IndexError, ValueError):
+            return 0
+
+    def _source_mask(self, names) -> int:
+        mask = 0
+        for name in names:
+            if name not in self.sources:
+                if len(self.sources) >= MAX_SOURCES:
+                    continue
+                self.sources[name] = len(self.sources)
+                with open(self.sources_path, "w") as f:
+                    json.dump(self.sources, f)
+            mask |= 1 << self.sources[name]
+        return mask
+
+    def _segment(self, now: float) -> Segment:
+        if not self.segments or self.segments[-1].full:
+            stamp = max(int(now * 1000), int(self.segments[-1].start * 1000) + 1 if self.segments else 0)
+            segment = Segment(os.path.join(self.directory, f"history-{stamp}.bin"), self.segment_records)
+            with self._lock:
+                # Replace the list instead of changing it so a query keeps a consistent copy
+                segments = self.segments + [segment]
+                retired, self.segments = segments[:-self.max_segments], segments[-self.max_segments:]
+                for oldest in retired:
+                    oldest.retired = True
+                    if not oldest.readers:
+                        self._delete(oldest)
+        return self.segments[-1]
+
+    @staticmethod
+    def _delete(segment: Segment):
+        segment.close()
+        os.remove(segment.path)
+
+    def _acquire(self) -> list:
+        """The current segments, they aren't closed until _release is called with them"""
+        with self._lock:
+            segments = self.segments
+            for segment in segments:
+                segment.readers += 1
+        return segments
+
+    def _release(self, segments: list):
+        with self._lock:
+            for segment in segments:
+                segment.readers -= 1
+                if segment.retired and not segment.readers:
+                    self._delete(segment)
+
+    def record(self, inhibiting: bool, overridden: bool, sources, sessions: int, upload: float,
+               qbt_connection: bool = False, plex_connection: bool = False, net_connection: bool = False):
+        """Called on every decision, writes a transition record if the inhibit state changed and a sample record
+        if sample_interval has passed since the last one"""
+        now = time.time()
+        transition = self.last_inhibiting is not None and inhibiting != self.last_inhibiting
+        self.last_inhibiting = inhibiting
+        if not transition and now - self.last_sample < self.sample_interval:
+            return
+        self.last_sample = now
+        connections = ((CONNECTION_QBT if qbt_connection else 0) | (CONNECTION_PLEX if plex_connection else 0) |
+                       (CONNECTION_NET if net_connection else 0))
+        self._segment(now).append((now, TRANSITION if transition else SAMPLE, bool(inhibiting), bool(overridden),
+                                   connections, self._source_mask(sources), min(sessions, 0xFFFF), upload))
+
+    @staticmethod
+    def _ranges(segments: list, start: float, end: float):
+        """Yield the raw bytes of every record between start and end, segment by segment"""
+        for i, segment in enumerate(segments):
+            next_start = segments[i + 1].start if i + 1 < len(segments) else float("inf")
+            if next_start < start or segment.start > end:
+                continue
+            count = segment.count  # Read once so a concurrent append doesn't change the range
+            first, last = segment.find(start, count), segment.find(end, count)
+            if last > first:
+                yield segment.view(first, last)
+
+    def query(self, start: float, end: float, bucket: float = None) -> dict:
+        """Aggregate the records between start and end, if bucket is given the range is also split into buckets
+        of that many seconds. Safe to call from another thread than record()"""
+        segments = self._acquire()
+        views = []
+        try:
+            views = list(self._ranges(segments, start, end))
+            return self._query(views, start, end, bucket)
+        finally:
+            # Nothing may still point into the maps when a retired segment is closed
+            for view in views:
+                view.release()
+            self._release(segments)
+
+    def _query(self, views: list, start: float, end: float, bucket: float) -> dict:
+        names = {bit: name for name, bit in self.sources.items()}
+        if numpy is not None:
+            # The records are read straight out of the memory map, they are only copied if the range spans segments
+            arrays = [numpy.frombuffer(view, dtype=RECORD_DTYPE) for view in views]
+            records = arrays[0] if len(arrays) == 1 else numpy.concatenate(arrays) if arrays else \
+                numpy.empty(0, dtype=RECORD_DTYPE)
+            times = records["time"]
+            search = numpy.searchsorted
+            aggregate = self._aggregate_numpy
+        else:
+            records = [record for view in views for record in RECORD.iter_unpack(view)]
+            times = [record[0] for record in records]
+            search = bisect.bisect_left
+            aggregate = self._aggregate_python
+        result = aggregate(records, names)
+        result.update(start=start, end=end)
+        if bucket:
+            result["buckets"] = []
+            bucket_start = start
+            while bucket_start < end:
+                bucket_end = min(bucket_start + bucket, end)
+                first, last = int(search(times, bucket_start)), int(search(times, bucket_end))
+                bucket_result = aggregate(records[first:last], names)
+                bucket_result.update(start=bucket_start, end=bucket_end)
+                result["buckets"].append(bucket_result)
+                bucket_start = bucket_end
+        return result
+
+    def _aggregate_numpy(self, records, names: dict) -> dict:
+        result = {"records": int(len(records)), "transitions": 0, "inhibited_seconds": 0.0, "sources": {},
+                  "max_sessions": 0, "avg_upload": 0.0, "max_upload": 0.0}
+        if not len(records):
+            return result
+        # Each record's state lasts until the next record
+        durations = numpy.diff(records["time"], append=records["time"][-1])
+        durations[durations > self.max_gap] = 0
+        inhibiting = records["inhibiting"].astype(bool)
+        result["transitions"] = int(numpy.count_nonzero((records["kind"] == TRANSITION) & inhibiting))
+        result["inhibited_seconds"] = float(durations[inhibiting].sum())
+        for bit, name in names.items():
+            seconds = float(durations[(records["sources"] & (1 << bit)) != 0].sum())
+            if seconds:
+                result["sources"][name] = seconds
+        result["max_sessions"] = int(records["sessions"].max())
+        result["avg_upload"] = float(records["upload"].mean())
+        result["max_upload"] = float(records["upload"].max())
+        return result
+
+    def _aggregate_python(self, records: list, names: dict) -> dict:
+        """Degraded fallback of _aggregate_numpy for installs without numpy, a month of samples takes a third of a
+        second instead of milliseconds"""
+        result = {"records": len(records), "transitions": 0, "inhibited_seconds": 0.0, "sources": {},
+                  "max_sessions": 0, "avg_upload": 0.0, "max_upload": 0.0}
+        if not records:
+            return result
+        upload_total = 0.0
+        for i, (timestamp, kind, inhibiting, _, _, sources, sessions, upload) in enumerate(records):
+            duration = records[i + 1][0] - timestamp if i + 1 < len(records) else 0
+            if duration > self.max_gap:
+                duration = 0
+            if inhibiting:
+                result["inhibited_seconds"] += duration
+                if kind == TRANSITION:
+                    result["transitions"] += 1
+            for bit, name in names.items():
+                if sources & (1 << bit) and duration:
+                    result["sources"][name] = result["sources"].get(name, 0) + duration
+            result["max_sessions"] = max(result["max_sessions"], sessions)
+            result["max_upload"] = max(result["max_upload"], upload)
+            upload_total += upload
+        result["avg_upload"] = upload_total / len(records)
+        return result
+
+    def close(self):
+        with self._lock:
+            segments, self.segments = self.segments, []
+        for segment in segments:
+            segment.flush()
+            segment.close()
@@ -0,0 +1,140 @@
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+""" Logging goes through a queue so the event loop never waits on the disk or the terminal, the records are
+    formatted (tracebacks included) and written by a QueueListener thread.
+    Repeated identical warnings and errors (an upstream that is down fails the same way on every poll) are only
+    written once per repeat_window, with a "N occurrences in the last T seconds" summary once the window is over.
+"""
+
+TEXT_FORMAT = r"[%(asctime)s - %(levelname)s - %(threadName)s - %(name)s - %(funcName)s - %(message)s]"
+
+
+class JsonFormatter(logging.Formatter):
+    """One json object per line"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "function": record.funcName,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        if getattr(record, "occurrences", None):
+            entry["occurrences"] = record.occurrences
+            entry["window"] = record.window
+        return json.dumps(entry)
+
+
+class RateLimitedQueueHandler(logging.handlers.QueueHandler):
+    """Puts records on the queue for the writer thread, collapsing repeats of the same warning or error"""
+
+    def __init__(self, log_queue: queue.Queue, repeat_window: float = 60, clock=time.monotonic):
+        super().__init__(log_queue)
+        self.repeat_window = repeat_window
+        self.clock = clock
+        self._seen = {}  # (level, location, message) -> [window start, suppressed count, first record]
+        self._lock = threading.Lock()
+        self._next_flush = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The default prepare formats the record (and its traceback) in the calling thread, only merge the args
+        # here and leave the rest of the formatting to the writer thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def emit(self, record: logging.LogRecord):
+        if record.levelno >= logging.WARNING and self.repeat_window:
+            now = self.clock()
+            key = (record.levelno, record.pathname, record.lineno, record.getMessage())
+            with self._lock:
+                seen = self._seen.get(key)
+                if seen is not None and now - seen[0] < self.repeat_window:
+                    seen[1] += 1
+                    return
+                # Keep a copy without the traceback, it would keep the frames of the failed call alive
+                first = logging.makeLogRecord(dict(record.__dict__, exc_info=None, exc_text=None))
+                self._seen[key] = [now, 0, first]
+                if seen is not None and seen[1]:
+                    self._summarize(seen, now)
+        self._flush_expired()
+        super().emit(record)
+
+    def _summarize(self, seen: list, now: float):
+        start, count, record = seen
+        summary = logging.makeLogRecord(record.__dict__)
+        summary.msg = f"{record.getMessage()} ({count} occurrences in the last {now - start:.0f} seconds)"
+        summary.args = None
+        summary.created = time.time()
+        summary.msecs = summary.created % 1 * 1000
+        summary.occurrences = count
+        summary.window = round(now - start)
+        super().emit(summary)
+
+    def _flush_expired(self):
+        """Write the summaries of repeats that stopped, checked at most once a second"""
+        now = self.clock()
+        if now < self._next_flush:
+            return
+        self._next_flush = now + 1
+        with self._lock:
+            for key, seen in list(self._seen.items()):
+                if now - seen[0] >= self.repeat_window:
+                    del self._seen[key]
+                    if seen[1]:
+                        self._summarize(seen, now)
+
+    def flush_summaries(self):
+        with self._lock:
+            now = self.clock()
+            for seen in self._seen.values():
+                if seen[1]:
+                    self._summarize(seen, now)
+            self._seen = {}
+
+
+def setup_logging(level: str = "INFO", format: str = "json", file: str = None,
+                  repeat_window: float = 60) -> logging.handlers.QueueListener:
+    """Route the root logger through a queue to a writer thread, returns the listener, stop it on exit to flush
+    the queue"""
+    if format not in ("json", "text"):
+        raise ValueError(f"Unknown log format {format}")
+    output = logging.FileHandler(file) if file else logging.StreamHandler(sys.stderr)
+    output.setFormatter(JsonFormatter() if format == "json" else logging.Formatter(TEXT_FORMAT))
+    log_queue = queue.SimpleQueue()
+    handler = RateLimitedQueueHandler(log_queue, repeat_window)
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+        existing.close()
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(log_queue, output)
+    listener.start()
+    return listener
+
+
+def stop_logging(listener: logging.handlers.QueueListener):
+    """Write the pending repeat summaries and wait for the writer thread to empty the queue"""
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, RateLimitedQueueHandler):
+            handler.flush_summaries()
+    listener.stop()
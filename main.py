@@ -1,140 +1,239 @@
 import datetime
-import json
-
-import qbittorrentapi
+import signal
 
 import asyncio
 
-from net_detector import NetDetector
-from plex_detector import PlexDetector
+from config import ConfigWatcher, load_config
+from detector import DetectorContext, load_detector_class
+from detector_worker import DetectorWorker
+from qbt_instance import QbtInstance
 from web_api import WebAPI
-from helpers import InhibitSource, PlexInhibitor, WebInhibitor, APIInhibitor, InhibitHolder, NetInhibitor
+from helpers import InhibitSource, PlexInhibitor, WebInhibitor, APIInhibitor, InhibitHolder, NetInhibitor, decide
+from history import History
 import logging
 import auto_update
-
-logging.basicConfig(level=logging.INFO,
-                    format=r"[%(asctime)s - %(levelname)s - %(threadName)s - %(name)s - %(funcName)s - %(message)s]")
+from log_pipeline import setup_logging, stop_logging
+from scheduler import Scheduler
+from supervisor import Supervisor
 
 
 class qbtInhibitor:
 
-    def __init__(self, qbt_url, qbt_username, qbt_password, plex_url, plex_token, api_ip, main_limit=None,
-                 alt_limit=None):
-        self.qbt_url = qbt_url
-        self.qbt_username = qbt_username
-        self.qbt_password = qbt_password
-        self.plex_url = plex_url
-        self.plex_token = plex_token
-        self.qbt = qbittorrentapi.Client(host=self.qbt_url, username=self.qbt_username, password=self.qbt_password)
-        self.qbt_connected = False
-        self.qbt_was_connected = True
-
-        self.api_ip = api_ip
-        self.webapi = None
+    def __init__(self, config: dict, config_path: str = None):
+        """config is a normalized config from config.load_config, if config_path is given the file is watched and
+        changes to it are applied while running"""
+        self.config = config
+        self.scheduler = Scheduler()
+        self.supervisor = Supervisor()
+        self.detector_context = DetectorContext(self.scheduler, self.supervisor)
+
+        self.detector_configs = {detector["name"]: detector for detector in config["detectors"]}
+        self.detectors = {}  # Name -> the running instance of each detector
+        # With detector_worker set the detectors run in a worker process instead and self.detectors stays empty
+        self.detector_worker = None
+
+        self.qbt_configs = {instance["name"]: instance for instance in config["qbt_instances"]}
+        self.qbt_instances = {name: self._make_qbt_instance(instance) for name, instance in self.qbt_configs.items()}
+        self._rate_limit_tasks = set()  # Keeps the background set_rate_limit calls referenced until they finish
 
-        self.qbt_main_limit = main_limit
-        self.qbt_alt_limit = alt_limit
+        self.webapi = None
+        self.config_watcher = ConfigWatcher(config_path, self.apply_config, self.scheduler) if config_path else None
 
         self.stop = False
 
         self.last_inhibit_sources = []  # This is to keep track of changes in the inhibit sources
 
         self.inhibit_sources = InhibitHolder()
-        self.tasks = []
+        # Options for History, history is kept in ./history unless it is set to false in the config
+        self.history = History(**(config["history"] or {})) if config["history"] is not False else None
         self.inhibiting = False  # This is a flag to indicate if we are currently inhibiting or not
 
         self.updater = auto_update.GithubUpdater("JayFromProgramming", "QBT_inhibitor",
                                                  self.update_restart, self.on_new_version)
-        self.update_task = asyncio.get_event_loop().create_task(self.updater.run())
-
-    def _task_done(self, task):
-        if not self.stop:
-            logging.info(f"Task {task.get_name()} failed, restarting")
-            task.cancel()
-            self.tasks.remove(task)
-            if task.get_name() == "plex_detector":
-                logging.info(f"Restarting plexDetector")
-                # Remove any PlexInhibitor from the list of sources
-                self.inhibit_sources.remove_by_type(PlexInhibitor)
-                plex_source = PlexInhibitor()
-                plex = PlexDetector(self.plex_url, self.plex_token, plex_source)
-                self.inhibit_sources.append(plex_source)
-                self.tasks.append(asyncio.get_event_loop().create_task(plex.run(), name="plex_detector"))
-            elif task.get_name() == "api_server":
-                logging.info(f"Restarting webapi")
-                # Remove any APIInhibitor from the list of sources
-                self.inhibit_sources.remove_by_type(APIInhibitor)
-                webapi_source = APIInhibitor()
-                webapi_source.version = self.updater.get_installed_version()
-                webapi_source.service_restart_method = self.update_restart
-                webapi_source.service_update_response = self.on_update_response
-                webapi_source.version = self.updater.get_installed_version()
-                webapi = WebAPI(self.api_ip, 47675, 47676, webapi_source)
-                self.inhibit_sources.append(webapi_source)
-                self.tasks.append(asyncio.get_event_loop().create_task(webapi.run(), name="api_server"))
-            elif task.get_name() == "net_detector":
-                logging.info(f"Restarting net_detector")
-                # Remove any NetInhibitor from the list of sources
-                self.inhibit_sources.remove_by_type(NetInhibitor)
-                net_source = NetInhibitor()
-                net = NetDetector("wg0", 0.5, net_source)
-                self.inhibit_sources.append(net_source)
-                self.tasks.append(asyncio.get_event_loop().create_task(net.run(), name="net_detector"))
-        else:
-            logging.info(f"Task {task.get_name()} failed, but we are stopping, so not restarting")
-
-    async def __aenter__(self):
-        """This is where the real init action is"""
-        logging.info(f"Initializing qbtInhibitor, connecting to qbittorrent as {self.qbt_username}")
-        self._qbt_login()
-        logging.info(f"Connected to qbittorrent as {self.qbt_username}, starting plexDetector")
-        plex_source = PlexInhibitor()
-        plex = PlexDetector(self.plex_url, self.plex_token, plex_source)
-        self.inhibit_sources.append(plex_source)
-        self.tasks.append(asyncio.get_event_loop().create_task(plex.run(), name="plex_detector"))
-
-        logging.info(f"Starting webapi tasks")
+        self.update_task = asyncio.get_event_loop().create_task(self.updater.run(self.scheduler))
+
+    def _make_qbt_instance(self, config: dict) -> QbtInstance:
+        name = config["name"]
+        return QbtInstance(name, config["url"], config["user"], config["password"],
+                           breaker=self.supervisor.breaker(f"qbt:{name}"),
+                           timeout=config.get("timeout", 10),
+                           throttle_mode=config.get("throttle_mode", QbtInstance.GLOBAL),
+                           throttle_top=config.get("throttle_top", 5),
+                           throttle_limit=config.get("throttle_limit", 10240),
+                           throttle_min_speed=config.get("throttle_min_speed", 1024))
+
+    def _add_qbt(self, instance: QbtInstance):
+        self.supervisor.add(f"qbt:{instance.name}", lambda: instance.run(self.scheduler, lambda: self.inhibiting),
+                            QbtInstance.restart_policy)
+
+    def _add_detector(self, name: str):
+        detector_class = load_detector_class(self.detector_configs[name]["type"])
+        logging.info(f"Starting {detector_class.__name__} {name}")
+        self.supervisor.add(name, lambda: self._start_detector(name, detector_class), detector_class.restart_policy)
+
+    def _add_detector_worker(self):
+        self.detector_worker = DetectorWorker(list(self.detector_configs.values()), self.inhibit_sources,
+                                              self.scheduler, self.config["logging"])
+        self.supervisor.add("detector_worker", self.detector_worker.run, DetectorWorker.restart_policy)
+
+    def _start_detector(self, name: str, detector_class):
+        # Remove the source left over from a previous run of the task
+        if self.inhibit_sources.get_source(name) is not None:
+            self.inhibit_sources.remove_by_name(name)
+        source = detector_class.source_class(name)
+        detector = detector_class(name, self.detector_configs[name], source, self.detector_context)
+        self.detectors[name] = detector
+        self.inhibit_sources.append(source)
+        return detector.run()
+
+    def _start_webapi(self):
+        # Remove any APIInhibitor left over from a previous run of the task
+        self.inhibit_sources.remove_by_type(APIInhibitor)
         webapi_source = APIInhibitor()
         webapi_source.version = self.updater.get_installed_version()
         webapi_source.service_restart_method = self.update_restart
         webapi_source.service_update_response = self.on_update_response
-        webapi = WebAPI(self.api_ip, 47675, 47676, webapi_source)
+        webapi_source.service_history_query = self.query_history
+        webapi_source.service_stats = lambda: {"scheduler": self.scheduler.dump()}
+        webapi = WebAPI(self.config["api_ip"], self.config["api_port"], self.config["api_alt_port"], webapi_source,
+                        scheduler=self.scheduler)
         self.webapi = webapi
         self.inhibit_sources.append(webapi_source)
-        self.tasks.append(asyncio.get_event_loop().create_task(webapi.run(), name="api_server"))
-
-        logging.info(f"Starting net_detector")
-        net_source = NetInhibitor()
-        net = NetDetector("wg0", 0.5, net_source)
-        self.inhibit_sources.append(net_source)
-        self.tasks.append(asyncio.get_event_loop().create_task(net.run(), name="net_detector"))
+        return webapi.run()
 
-        for task in self.tasks:  # This is to make sure that we get exceptions in the tasks if they fail
-            task.add_done_callback(self._task_done)
+    async def __aenter__(self):
+        """This is where the real init action is"""
+        logging.info(f"Initializing qbtInhibitor, connecting to {len(self.qbt_instances)} qbittorrent instances")
+        await asyncio.gather(*(instance.login() for instance in self.qbt_instances.values()))
+        for instance in self.qbt_instances.values():
+            self._add_qbt(instance)
+        if self.config["detector_worker"]:
+            logging.info(f"Starting {len(self.detector_configs)} detectors in a worker process")
+            self._add_detector_worker()
+        else:
+            for name in self.detector_configs:
+                self._add_detector(name)
+        logging.info(f"Starting webapi tasks")
+        self.supervisor.add("api_server", self._start_webapi, WebAPI.restart_policy)
+        if self.config_watcher is not None:
+            self.config_watcher.start()
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         self.stop = True
+        if self.config_watcher is not None:
+            self.config_watcher.stop()
         logging.info(f"Exiting qbtInhibitor, logging out of qbittorrent")
-        self.qbt.auth_log_out()
+        # Stop the health checks and let pending rate limit changes finish first so nothing throttles the torrents
+        # again after logout() restored them
+        await asyncio.gather(*(self.supervisor.remove(f"qbt:{name}") for name in self.qbt_instances))
+        await asyncio.gather(*self._rate_limit_tasks, return_exceptions=True)
+        await asyncio.gather(*(instance.logout() for instance in self.qbt_instances.values()))
+        for instance in self.qbt_instances.values():
+            instance.close()
         logging.info(f"Logged out of qbittorrent, stopping all tasks")
         for source in self.inhibit_sources:
             source.shutdown = True
+        self.scheduler.shutdown()
         logging.info(f"Stopped all tasks, waiting for them to stop")
-        await asyncio.sleep(5)
-        await asyncio.gather(*self.tasks, return_exceptions=True)
+        await self.supervisor.stop(timeout=10)
+        await self.detector_context.close()
+        if self.history is not None:
+            self.history.close()
         return self
 
-    def _qbt_login(self):
-        try:
-            self.qbt.auth_log_in(self.qbt_username, self.qbt_password)
-            self.qbt_connected = True
-        except Exception as e:
-            logging.error(f"Failed to login to qbittorrent: {e}")
-            self.qbt_connected = False
+    async def apply_config(self, config: dict):
+        """Called by the config watcher with a new validated config, only the parts that changed are restarted.
+        The inhibit state, the api sessions and everything that didn't change keep running"""
+        old = self.config
+        self.config = config
+
+        new_detectors = {detector["name"]: detector for detector in config["detectors"]}
+        if old["detector_worker"] != config["detector_worker"]:
+            logging.warning("detector_worker changed, it will be applied on the next restart")
+        if self.detector_worker is not None:
+            if new_detectors != self.detector_configs:
+                # The worker owns every detector, any change starts a new worker with the new configs
+                logging.info("Detectors changed, restarting the detector worker")
+                await self.supervisor.remove("detector_worker")
+                self.detector_worker.remove_sources()
+                self.detector_configs = new_detectors
+                self._add_detector_worker()
+            new_detectors = self.detector_configs
+        for name in self.detector_configs.keys() - new_detectors.keys():
+            logging.info(f"Detector {name} was removed from the config")
+            await self.supervisor.remove(name)
+            if self.inhibit_sources.get_source(name) is not None:
+                self.inhibit_sources.remove_by_name(name)
+            self.detectors.pop(name, None)
+            del self.detector_configs[name]
+        for name, detector_config in new_detectors.items():
+            if name not in self.detector_configs:
+                self.detector_configs[name] = detector_config
+                self._add_detector(name)
+            elif detector_config != self.detector_configs[name]:
+                type_changed = detector_config["type"] != self.detector_configs[name]["type"]
+                self.detector_configs[name] = detector_config
+                detector = self.detectors.get(name)
+                if not type_changed and detector is not None and detector.retune(detector_config):
+                    logging.info(f"Retuned detector {name}")
+                elif type_changed:
+                    await self.supervisor.remove(name)
+                    self._add_detector(name)
+                else:
+                    await self.supervisor.restart(name)
+
+        new_instances = {instance["name"]: instance for instance in config["qbt_instances"]}
+        for name in self.qbt_configs.keys() | new_instances.keys():
+            if self.qbt_configs.get(name) == new_instances.get(name):
+                continue
+            if name in self.qbt_instances:
+                logging.info(f"qbittorrent instance {name} was changed or removed, disconnecting from it")
+                await self.supervisor.remove(f"qbt:{name}")
+                instance = self.qbt_instances.pop(name)
+                await instance.logout()
+                instance.close()
+            if name in new_instances:
+                # The health check logs in and brings the new instance in line with the current inhibit state
+                self.qbt_instances[name] = self._make_qbt_instance(new_instances[name])
+                self._add_qbt(self.qbt_instances[name])
+        self.qbt_configs = new_instances
+
+        if any(old[key] != config[key] for key in ("api_ip", "api_port", "api_alt_port")):
+            logging.info(f"The api address changed, rebinding to {config['api_ip']}")
+            if self.webapi is not None and self.webapi.server is not None:
+                try:
+                    await self.webapi.rebind(config["api_ip"], config["api_port"], config["api_alt_port"])
+                except Exception as e:
+                    logging.error(f"Failed to rebind the api to {config['api_ip']}, still serving on the old "
+                                  f"address: {e}")
+            else:
+                # The server isn't up (it is waiting out a restart backoff), it binds to the new address when it
+                # starts
+                logging.info("The api server isn't running, it will use the new address when it starts")
+
+        if old["decision_interval"] != config["decision_interval"] and "decision" in self.scheduler.jobs:
+            self.scheduler.jobs["decision"].set_interval(config["decision_interval"])
+        if old["history"] != config["history"]:
+            logging.warning("History settings changed, they will be applied on the next restart")
+        if old["logging"] != config["logging"]:
+            # The level can change right away, the output and format are set up once at start
+            logging.getLogger().setLevel(config["logging"].get("level", "INFO"))
+            logging.info("Logging settings changed, the output and format are applied on the next restart")
+
+    @property
+    def qbt_connected(self):
+        return all(instance.connected for instance in self.qbt_instances.values())
 
     def _set_rate_limit(self, rate_limit: bool):
-        self.qbt.transfer_set_speed_limits_mode(rate_limit)
+        """Apply the speed limit mode to every connected instance in the background, the decision loop doesn't wait
+        for slow instances. Each instance runs its calls in order, instances that are not connected are brought in
+        line by their health check once they reconnect"""
+        for instance in self.qbt_instances.values():
+            task = asyncio.get_event_loop().create_task(instance.set_rate_limit(rate_limit),
+                                                        name=f"qbt:{instance.name}: set rate limit")
+            self._rate_limit_tasks.add(task)
+            task.add_done_callback(self._rate_limit_tasks.discard)
 
     def _inhibit(self, source: InhibitSource, inhibit: bool):
         pass
@@ -180,70 +279,83 @@ class qbtInhibitor:
         self.inhibit_sources.update_state(message="Restarting...")
         await asyncio.sleep(5)
         self.stop = True
-
-    async def run(self):
-        while not self.stop:
-            logging.debug(f"Checking if we need to inhibit")
-            if not self.qbt_connected:
-                logging.warning("qbittorrent is not connected, trying to connect")
-                self._qbt_login()
-            else:
-                logging.debug("qbittorrent is connected")
-
-            should_inhibit = False
-            overridden = False
-            sources = []
-
-            try:
-                logging.debug("Checking if we are still connected to qbt")
-                _ = self.qbt.transfer_download_limit()
-            except Exception as e:
-                logging.error(f"Failed to check if we are still connected to qbt: {e}")
-                self.qbt_connected = False
-
-            for source in self.inhibit_sources:
-                if source.is_override:
-                    should_inhibit = source.should_inhibit
-                    # sources.append(source)
-                    sources = [str(source)]
-                    overridden = True
-                    break
-                else:
-                    if source.should_inhibit:
-                        should_inhibit = True
-                        sources.append(str(source))
-
-            if should_inhibit:
-                if sources != self.last_inhibit_sources:
-                    self.inhibit_sources.update_state(inhibiting=True, inhibited_by=sources, overridden=overridden)
-                if not self.inhibiting:
-                    logging.info(f"Inhibiting qbittorrent because of {sources}")
-                    self.inhibiting = True
-                    self._set_rate_limit(True)
-            else:
-                if self.inhibiting:
-                    self.inhibit_sources.update_state(inhibiting=False, inhibited_by=sources, overridden=overridden)
-                    logging.info(f"No longer inhibiting qbittorrent")
-                    self.inhibiting = False
-                    self._set_rate_limit(False)
-            self.last_inhibit_sources = sources
+        self.scheduler.shutdown()
+
+    def _connected(self, source_type: type):
+        """True if every detector with a source of this type is connected, None if there are none"""
+        sources = self.inhibit_sources.get_all_by_type(source_type)
+        if not sources:
+            return None
+        return all(source.connected for source in sources)
+
+    async def _check(self):
+        """Scheduled job, decides if qbittorrent should be inhibited"""
+        logging.debug("Checking if we need to inhibit")
+        if self.detector_worker is not None:
+            self.detector_worker.read()
+        snapshot = self.inhibit_sources.snapshot()
+        should_inhibit, overridden, sources, source_names = decide(snapshot)
+
+        if should_inhibit:
+            if sources != self.last_inhibit_sources:
+                self.inhibit_sources.update_state(inhibiting=True, inhibited_by=sources, overridden=overridden)
+            if not self.inhibiting:
+                logging.info(f"Inhibiting qbittorrent because of {sources}")
+                self.inhibiting = True
+                self._set_rate_limit(True)
+        else:
+            if self.inhibiting:
+                self.inhibit_sources.update_state(inhibiting=False, inhibited_by=sources, overridden=overridden)
+                logging.info(f"No longer inhibiting qbittorrent")
+                self.inhibiting = False
+                self._set_rate_limit(False)
+        self.last_inhibit_sources = sources
+        try:
+            self.inhibit_sources.silent_update_state(
+                qbt_connection=self.qbt_connected,
+                qbt_instances={name: instance.dump() for name, instance in self.qbt_instances.items()},
+                plex_connection=self._connected(PlexInhibitor),
+                net_connection=self._connected(NetInhibitor),
+                detectors=self.detector_worker.health() if self.detector_worker is not None else
+                {name: detector.health() for name, detector in self.detectors.items()},
+                services=self.supervisor.dump())
+        except Exception as e:
+            logging.error(f"Failed to update inhibit sources: {e}")
+        if self.history is not None:
             try:
-                self.inhibit_sources.silent_update_state(
-                    qbt_connection=self.qbt_connected, plex_connection=
-                    self.inhibit_sources.get_by_type(PlexInhibitor).connected_to_plex,
-                    net_connection=self.inhibit_sources.get_by_type(NetInhibitor).connected_to_net)
+                self.history.record(
+                    self.inhibiting, overridden, source_names if should_inhibit else [],
+                    sum(source.sessions for source in snapshot.sources),
+                    sum(source.upload for source in self.inhibit_sources.get_all_by_type(NetInhibitor)),
+                    qbt_connection=self.qbt_connected, plex_connection=self._connected(PlexInhibitor),
+                    net_connection=self._connected(NetInhibitor))
             except Exception as e:
-                logging.error(f"Failed to update inhibit sources: {e}")
-            await asyncio.sleep(5)
+                logging.error(f"Failed to record history: {e}")
 
+    async def query_history(self, start: float, end: float, bucket: float = None):
+        """Called by the webapi, the query runs in a thread so a long range doesn't block the event loop"""
+        if self.history is None:
+            raise ValueError("History is disabled")
+        return await asyncio.to_thread(self.history.query, start, end, bucket)
 
-async def main():
-    with open("config.json") as config_file:
-        config = json.load(config_file)
-    async with qbtInhibitor(config['qbt_url'], config['qbt_user'],
-                            config['qbt_password'], config['plex_url'], config['plex_token'],
-                            config['api_ip']) as inhibitor:
-        await inhibitor.run()
+    async def run(self):
+        await self.scheduler.every("decision", self._check, self.config["decision_interval"], cost=2)
 
 
-asyncio.get_event_loop().run_until_complete(main())
+async def main():
+    config = load_config("config.json")
+    listener = setup_logging(**config["logging"])
+    try:
+        async with qbtInhibitor(config, "config.json") as inhibitor:
+            # Stop through the scheduler so __aexit__ runs and the throttled torrents are restored
+            loop = asyncio.get_running_loop()
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                loop.add_signal_handler(signum, inhibitor.scheduler.shutdown)
+            await inhibitor.run()
+    finally:
+        stop_logging(listener)
+
+
+# The detector worker process is started with spawn, which imports this module again in the worker
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,84 @@
+import logging
+
+import aiohttp
+
+from detector import Detector, DetectorContext, get_local_subnets
+from helpers import EmbyInhibitor, JellyfinInhibitor, MediaInhibitor
+from supervisor import RestartPolicy
+
+
+class EmbyDetector(Detector):
+    """Detects remote playback on an Emby server through its /Sessions endpoint, Jellyfin forked from Emby and
+    serves the same endpoint so JellyfinDetector only changes the source type
+
+    Config: {"type": "emby", "name": ..., "url": ..., "token": ... (api key), "timeout": 10}"""
+
+    source_class = EmbyInhibitor
+    restart_policy = RestartPolicy(base_delay=2, max_delay=120)
+
+    active_interval = 5
+    idle_interval = 15
+    interval = active_interval
+    cost = 3
+
+    required = ("url", "token")
+    interval_fields = ("interval", "active_interval", "idle_interval")
+    tunable = interval_fields
+
+    def __init__(self, name: str, config: dict, interface_class: MediaInhibitor, context: DetectorContext):
+        super().__init__(name, config, interface_class, context)
+        self.url = config["url"].rstrip("/")
+        self.token = config["token"]
+        self.timeout = aiohttp.ClientTimeout(total=config.get("timeout", 10))
+        logging.info(f"Initializing {type(self).__name__} {name} for {self.url}")
+        self.breaker = context.supervisor.breaker(name)
+        self.local_subnets = get_local_subnets()
+
+    async def _get_sessions(self):
+        async with self.context.http_session.get(f"{self.url}/Sessions", headers={"X-Emby-Token": self.token},
+                                                 params={"ActiveWithinSeconds": 960},
+                                                 timeout=self.timeout) as resp:
+            resp.raise_for_status()
+            return await resp.json()
+
+    def _is_remote_stream(self, session: dict) -> bool:
+        if "NowPlayingItem" not in session or session.get("PlayState", {}).get("IsPaused", False):
+            return False
+        address = session.get("RemoteEndPoint", "")
+        if any(address.startswith(subnet) for subnet in self.local_subnets):
+            logging.debug("Player %s is on the same subnet as the server", address)
+            return False
+        return True
+
+    async def poll(self):
+        """Scheduled job, returns the interval until the next poll"""
+        if not self.breaker.allow():
+            self.interface_class.connected = False
+            self.interface_class.should_inhibit = False
+            return self.idle_interval
+        logging.debug("Checking activity on %s", self.name)
+        try:
+            sessions = await self._get_sessions()
+        except Exception as e:
+            logging.error(f"Failed to get activity from {self.name}: {e}", exc_info=True)
+            self.breaker.record_failure()
+            self.interface_class.connected = False
+            self.interface_class.should_inhibit = False
+            return self.idle_interval
+        self.breaker.record_success()
+        self.interface_class.connected = True
+        self.interface_class.total_sessions = sum(1 for session in sessions if self._is_remote_stream(session))
+        self.interface_class.should_inhibit = self.interface_class.total_sessions > 0
+        if self.interface_class.total_sessions > 0:
+            return self.active_interval
+        return self.idle_interval
+
+    def health(self) -> dict:
+        return {"connected": self.interface_class.connected, "sessions": self.interface_class.total_sessions,
+                "breaker": self.breaker.state}
+
+
+class JellyfinDetector(EmbyDetector):
+    """Config: {"type": "jellyfin", "name": ..., "url": ..., "token": ... (api key), "timeout": 10}"""
+
+    source_class = JellyfinInhibitor
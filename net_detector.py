@@ -1,48 +1,77 @@
-import asyncio
 import logging
-import traceback
+import time
 
 import psutil
 
+from detector import Detector, DetectorContext
 from helpers import NetInhibitor
+from supervisor import RestartPolicy
 
-logging.getLogger(__name__).setLevel(logging.DEBUG)
 
+class NetDetector(Detector):
+    """Inhibits while the upload rate of a network interface is above a threshold
 
-class NetDetector:
+    Config: {"type": "net", "name": ..., "interface": "wg0", "threshold": 0.5 (mbit/s)}"""
 
-    def __init__(self, net_interface: str, threshold: float, interface_class: NetInhibitor):
-        self.net_interface = net_interface
-        self.threshold = threshold
-        self.interface_class = interface_class
+    source_class = NetInhibitor
+    restart_policy = RestartPolicy(base_delay=5, max_delay=300)
+
+    tunable = ("interval", "threshold")
+
+    @classmethod
+    def validate(cls, config: dict):
+        super().validate(config)
+        if not isinstance(config.get("threshold", 0.5), (int, float)):
+            raise ValueError(f"Detector {config.get('name')} has an invalid threshold: {config['threshold']}")
+
+    def retune(self, config: dict) -> bool:
+        if not super().retune(config):
+            return False
+        self.threshold = config.get("threshold", 0.5)
+        return True
+
+    def __init__(self, name: str, config: dict, interface_class: NetInhibitor, context: DetectorContext):
+        super().__init__(name, config, interface_class, context)
+        self.net_interface = config.get("interface", "wg0")
+        self.threshold = config.get("threshold", 0.5)
         self.interface_class.connected_to_net = True
+        self.last_sample = None  # (time, bytes_sent) from the previous poll
+        self.clock = time.monotonic  # Replaced by the simulator's virtual clock
 
-    # Get the upload stats from the interface
-    @staticmethod
-    async def get_network_upload(interface_name):
-        old_value = psutil.net_io_counters(pernic=True)[interface_name].bytes_sent
-        await asyncio.sleep(1)
-        new_value = psutil.net_io_counters(pernic=True)[interface_name].bytes_sent
-        return new_value - old_value
+    def read_bytes_sent(self):
+        return psutil.net_io_counters(pernic=True)[self.net_interface].bytes_sent
+
+    # Get the upload rate of the interface in bytes per second since the last poll
+    def get_network_upload(self):
+        bytes_sent = self.read_bytes_sent()
+        now = self.clock()
+        last_sample, self.last_sample = self.last_sample, (now, bytes_sent)
+        if last_sample is None or now <= last_sample[0] or bytes_sent < last_sample[1]:
+            return None  # First sample or the counter was reset, no rate yet
+        return (bytes_sent - last_sample[1]) / (now - last_sample[0])
 
     # Convert bytes to mbit
     @staticmethod
     def convert_to_mbit(value):
         return value / 1024. / 1024. * 8
 
+    async def poll(self):
+        self._sample()
+
+    def _sample(self):
+        logging.debug("Checking network upload")
+        try:
+            upload = self.get_network_upload()
+            if upload is not None:
+                self.interface_class.upload = self.convert_to_mbit(upload)
+                self.interface_class.should_inhibit = self.interface_class.upload > self.threshold
+        except Exception as e:
+            logging.error(f"Failed to get network upload: {e}", exc_info=True)
+            self.last_sample = None
+            self.interface_class.connected_to_net = False
+        else:
+            self.interface_class.connected_to_net = True
+
     async def run(self):
         logging.info(f"Initializing netDetector, checking {self.net_interface} with threshold {self.threshold} mbit/s")
-        while not self.interface_class.shutdown:
-            logging.debug("Checking network upload")
-            try:
-                if self.convert_to_mbit(await self.get_network_upload(self.net_interface)) > self.threshold:
-                    self.interface_class.should_inhibit = True
-                else:
-                    self.interface_class.should_inhibit = False
-            except Exception as e:
-                logging.error(f"Failed to get network upload: {e}\n{traceback.format_exc()}")
-                self.interface_class.connected_to_net = False
-            else:
-                self.interface_class.connected_to_net = True
-            finally:
-                await asyncio.sleep(5)
+        await super().run()
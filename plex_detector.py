@@ -1,85 +1,117 @@
 import asyncio
-import traceback
-import netifaces
 
 from plexapi.server import PlexServer
 
-from helpers import PlexInhibitor, InhibitSource
+from detector import Detector, DetectorContext, get_local_subnets
+from helpers import PlexInhibitor
+from supervisor import RestartPolicy
 
 import logging
 
-logging.getLogger(__name__).setLevel(logging.DEBUG)
 
-
-class PlexDetector:
+class PlexDetector(Detector):
     """Detects if anyone is streaming on a Plex server, and if so it determines if qbittorrent should have its upload
-    throttled"""
+    throttled
+
+    Config: {"type": "plex", "name": ..., "url": ..., "token": ...}"""
+
+    source_class = PlexInhibitor
+    restart_policy = RestartPolicy(base_delay=2, max_delay=120)
+
+    # Poll intervals, plex is polled quickly while someone is buffering and slowly while the server is idle
+    buffering_interval = 1
+    active_interval = 5
+    idle_interval = 15
+    interval = active_interval
+    cost = 5
+
+    required = ("url", "token")
+    interval_fields = ("interval", "buffering_interval", "active_interval", "idle_interval")
+    tunable = interval_fields
+
+    def __init__(self, name: str, config: dict, interface_class: PlexInhibitor, context: DetectorContext):
+        super().__init__(name, config, interface_class, context)
+        self.plex_url = config["url"]
+        self.plex_token = config["token"]
+        logging.info(f"Initializing plexDetector {name} for {self.plex_url}")
+        self.buffering = False  # Set if any remote session was buffering on the last poll
+        self.breaker = context.supervisor.breaker(name)
+        self.plex_server = None  # Connected on the first poll so a slow server doesn't block startup
+        self.local_subnets = get_local_subnets()
 
-    def __init__(self, plex_url, plex_token, interface_class=PlexInhibitor):
-        logging.info(f"Initializing plexDetector, connecting to {plex_url}")
-        self.plex_url = plex_url
-        self.plex_token = plex_token
+    def _connect(self):
+        """Connect to the plex server, the breaker stops us from hammering a server that is down"""
+        if not self.breaker.allow():
+            return False
         try:
-            self.plex_server = PlexServer(self.plex_url, self.plex_token)
+            self.plex_server = PlexServer(self.plex_url, self.plex_token, session=self.context.requests_session)
         except Exception as e:
-            logging.error(f"Failed to connect to {plex_url}: {e}")
+            logging.error(f"Failed to connect to {self.plex_url}: {e}")
+            self.breaker.record_failure()
             self.plex_server = None
-        self.interface_class = interface_class
-        logging.info(f"Connected to {plex_url}")
+            self.interface_class.connected_to_plex = False
+            return False
+        logging.info(f"Connected to {self.plex_url}")
+        self.breaker.record_success()
         self.interface_class.connected_to_plex = True
-        self.local_subnets = []
-        self._get_host_names()
-
-    def _get_host_names(self):
-        """
-        Gets all the ip addresses that can be bound to
-        """
-        interfaces = []
-        for interface in netifaces.interfaces():
-            try:
-                if netifaces.AF_INET in netifaces.ifaddresses(interface):
-                    for link in netifaces.ifaddresses(interface)[netifaces.AF_INET]:
-                        if link["addr"] != "":
-                            interfaces.append(link["addr"])
-            except Exception as e:
-                logging.debug(f"Error getting interface {interface}: {e}")
-                pass
-        for interface in interfaces:
-            logging.debug(f"Found interface {interface}")
-            self.local_subnets.append(".".join(interface.split(".")[0:3]))
+        return True
 
     def _get_activity(self):
         should_throttle = False
+        if self.plex_server is None:
+            if not self._connect():
+                return should_throttle
+        elif not self.breaker.allow():
+            self.interface_class.connected_to_plex = False
+            return should_throttle
         try:
             sessions = self.plex_server.sessions()
-            self.interface_class.total_sessions = 0
+            total_sessions = 0  # Counted here and set once, every change of the source bumps the state version
+            self.buffering = False
             for session in sessions:
                 try:
                     if session.players[0].state == "playing" or session.players[0].state == "buffering":
                         if any([session.players[0].address.startswith(subnet) for subnet in self.local_subnets]):
-                            logging.debug(f"Player {session.players[0].address} is on the same subnet as the server")
+                            logging.debug("Player %s is on the same subnet as the server", session.players[0].address)
                             continue
                         should_throttle = True
-                        self.interface_class.total_sessions += 1
+                        if session.players[0].state == "buffering":
+                            self.buffering = True
+                        total_sessions += 1
                 except Exception as e:
-                    logging.error(f"Failed to get session info: {e}")
-                    logging.error(traceback.format_exc())
+                    logging.error(f"Failed to get session info: {e}", exc_info=True)
+            self.interface_class.total_sessions = total_sessions
         except Exception as e:
-            logging.error(f"Failed to get plex activity: {e}\n{traceback.format_exc()}")
+            logging.error(f"Failed to get plex activity: {e}", exc_info=True)
+            self.breaker.record_failure()
             self.interface_class.connected_to_plex = False
         else:
+            self.breaker.record_success()
             self.interface_class.connected_to_plex = True
         return should_throttle
 
     def get_activity(self):
         return self._get_activity()
 
-    async def run(self):
-        while not self.interface_class.shutdown:
-            logging.debug("Checking plex activity")
-            if self._get_activity():
-                self.interface_class.should_inhibit = True
-            else:
-                self.interface_class.should_inhibit = False
-            await asyncio.sleep(5)
+    async def poll(self):
+        """Scheduled job, returns the interval until the next poll"""
+        logging.debug("Checking plex activity on %s", self.name)
+        # plexapi is blocking, run it in a thread so several servers can be polled at the same time
+        return self._update(await asyncio.to_thread(self._get_activity))
+
+    def _update(self, should_throttle: bool):
+        """Apply the result of a poll to the source, returns the interval until the next poll"""
+        if should_throttle:
+            self.interface_class.should_inhibit = True
+        else:
+            self.interface_class.should_inhibit = False
+        if self.buffering:
+            return self.buffering_interval
+        if self.interface_class.total_sessions > 0:
+            return self.active_interval
+        return self.idle_interval
+
+    def health(self) -> dict:
+        return {"connected": self.interface_class.connected, "sessions": self.interface_class.total_sessions,
+                "breaker": self.breaker.state}
 
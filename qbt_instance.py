@@ -0,0 +1,288 @@
+import asyncio
+import concurrent.futures
+import functools
+import heapq
+import logging
+
+import qbittorrentapi
+
+from scheduler import Scheduler
+from supervisor import RestartPolicy, CircuitBreaker
+
+
+class QbtInstance:
+    """A single qbittorrent client, the api client is blocking so every call is run in a worker thread of the
+    instance's own with a timeout, that way a slow or hung instance can't hold up the others
+
+    Throttle modes:
+        global - switch the whole client to its alternative speed limits
+        upload_limit - cap the upload limit of the throttle_top torrents that are uploading the most
+        pause - pause the throttle_top torrents that are uploading the most
+    In the per torrent modes at most throttle_top torrents are throttled at a time, a torrent that starts uploading
+    faster than a throttled one takes its place and the one it replaced is restored.
+    Throttled torrents are tagged in qbittorrent (see _tag) so that torrents a run couldn't restore (it was killed
+    or lost the connection) are restored the next time an instance logs in"""
+
+    restart_policy = RestartPolicy(base_delay=1, max_delay=60)
+
+    GLOBAL = "global"
+    UPLOAD_LIMIT = "upload_limit"
+    PAUSE = "pause"
+
+    # Only these fields of the torrent list are kept, everything else in the sync data is dropped
+    torrent_fields = ("upspeed", "up_limit", "state")
+
+    TAG_PREFIX = "qbt_inhibitor:"
+
+    def __init__(self, name: str, url: str, username: str, password: str, breaker: CircuitBreaker = None,
+                 timeout: float = 10, throttle_mode: str = GLOBAL, throttle_top: int = 5,
+                 throttle_limit: int = 10240, throttle_min_speed: int = 1024):
+        if throttle_mode not in (self.GLOBAL, self.UPLOAD_LIMIT, self.PAUSE):
+            raise ValueError(f"Unknown throttle mode {throttle_mode}")
+        self.name = name
+        self.url = url
+        self.username = username
+        self.password = password
+        # The requests timeout makes sure a call to a hung instance eventually returns and frees its thread
+        self.client = qbittorrentapi.Client(host=url, username=username, password=password,
+                                            REQUESTS_ARGS={"timeout": timeout})
+        self.breaker = breaker or CircuitBreaker(f"qbittorrent:{name}")
+        self.timeout = timeout
+        self.throttle_mode = throttle_mode
+        self.throttle_top = throttle_top  # How many torrents are throttled at most
+        self.throttle_limit = throttle_limit  # Upload limit in bytes/s used by the upload_limit mode
+        self.throttle_min_speed = throttle_min_speed  # Torrents uploading slower than this are left alone
+
+        self.torrents = {}  # Hash -> torrent fields, kept up to date from the incremental sync data
+        self.rid = 0  # Response id of the last sync, qbittorrent only sends what changed since this
+        # Hash -> (upload limit the torrent had before it was throttled, upload speed when it was throttled)
+        self.throttled = {}
+
+        self.connected = False
+        self.rate_limited = None  # The speed limit mode last applied to this instance, None if it is unknown
+        self.last_error = None
+        self._lock = asyncio.Lock()  # The client is not thread safe, only one call per instance at a time
+        # One thread per instance, a hung instance can only ever tie up its own thread and not the shared executor
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"qbt:{name}")
+
+    async def _call(self, method, *args, **kwargs):
+        # Don't queue up behind a call that is still stuck in the thread for longer than the timeout either
+        await asyncio.wait_for(self._lock.acquire(), self.timeout)
+        try:
+            future = asyncio.get_running_loop().run_in_executor(self._executor,
+                                                                functools.partial(method, *args, **kwargs))
+        except BaseException:
+            self._lock.release()
+            raise
+        # The lock is held until the call has actually finished in the thread, even if the caller stopped waiting
+        # for it, so the next call can't use the client at the same time
+        future.add_done_callback(lambda _: self._lock.release())
+        return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+
+    def _failed(self, action: str, e: Exception):
+        self.last_error = f"{type(e).__name__}: {e}"
+        logging.error(f"Failed to {action} qbittorrent {self.name}: {self.last_error}")
+        self.connected = False
+        self.rate_limited = None
+        self.breaker.record_failure()
+
+    async def login(self) -> bool:
+        if not self.breaker.allow():
+            logging.debug(f"qbittorrent {self.name} circuit breaker is open, not trying to login")
+            return False
+        try:
+            await self._call(self.client.auth_log_in, self.username, self.password)
+        except Exception as e:
+            self._failed("login to", e)
+            return False
+        logging.info(f"Connected to qbittorrent {self.name} as {self.username}")
+        self.connected = True
+        self.last_error = None
+        self.breaker.record_success()
+        try:
+            await self._recover()
+        except Exception as e:
+            logging.error(f"Failed to restore the torrents left throttled on qbittorrent {self.name}: {e}")
+        return True
+
+    async def check(self) -> bool:
+        """Make sure we are still connected, logging in again if we are not"""
+        if not self.connected:
+            logging.warning(f"qbittorrent {self.name} is not connected, trying to connect")
+            return await self.login()
+        try:
+            logging.debug("Checking if we are still connected to qbittorrent %s", self.name)
+            if self.throttle_mode == self.GLOBAL:
+                await self._call(self.client.transfer_download_limit)
+            else:
+                await self.sync()  # Doubles as the connection check
+        except Exception as e:
+            self._failed("check connection to", e)
+            return False
+        return True
+
+    async def sync(self):
+        """Bring the torrent list up to date from the changes since the last sync"""
+        data = await self._call(self.client.sync_maindata, rid=self.rid)
+        if data.get("full_update"):
+            self.torrents = {}
+        for torrent_hash, changes in data.get("torrents", {}).items():
+            torrent = self.torrents.setdefault(torrent_hash, {})
+            torrent.update((field, changes[field]) for field in self.torrent_fields if field in changes)
+        for torrent_hash in data.get("torrents_removed", []):
+            self.torrents.pop(torrent_hash, None)
+            self.throttled.pop(torrent_hash, None)
+        self.rid = data.get("rid", 0)
+
+    def plan_throttle(self) -> tuple:
+        """(hashes to throttle, hashes to restore) so that the throttle_top torrents uploading the most are the
+        throttled ones. A throttled torrent is capped or paused, so it ranks with the speed it had when it was
+        throttled and keeps its place on a tie"""
+        ranked = [(speed, True, torrent_hash) for torrent_hash, (_, speed) in self.throttled.items()]
+        ranked += [(torrent.get("upspeed", 0), False, torrent_hash) for torrent_hash, torrent in self.torrents.items()
+                   if torrent_hash not in self.throttled and torrent.get("upspeed", 0) >= self.throttle_min_speed]
+        top = {torrent_hash for _, _, torrent_hash in heapq.nlargest(self.throttle_top, ranked)}
+        return ([torrent_hash for torrent_hash in top if torrent_hash not in self.throttled],
+                [torrent_hash for torrent_hash in self.throttled if torrent_hash not in top])
+
+    def _tag(self, limit: int) -> str:
+        """The tag a throttled torrent gets, it says how to undo the throttle: qbt_inhibitor:paused or
+        qbt_inhibitor:limit:<upload limit the torrent had before>"""
+        if self.throttle_mode == self.PAUSE:
+            return f"{self.TAG_PREFIX}paused"
+        return f"{self.TAG_PREFIX}limit:{max(limit, 0)}"
+
+    async def _throttle(self, hashes: list):
+        """Throttle all the torrents with a single api call, the torrents are tagged first so they can always be
+        found again"""
+        if not hashes:
+            return
+        logging.info(f"Throttling {len(hashes)} torrents on qbittorrent {self.name} ({self.throttle_mode})")
+        by_tag = {}
+        for torrent_hash in hashes:
+            by_tag.setdefault(self._tag(self.torrents.get(torrent_hash, {}).get("up_limit", 0)), []).append(
+                torrent_hash)
+        for tag, tagged in by_tag.items():
+            await self._call(self.client.torrents_add_tags, tags=tag, torrent_hashes=tagged)
+        if self.throttle_mode == self.PAUSE:
+            await self._call(self.client.torrents_pause, torrent_hashes=hashes)
+        else:
+            await self._call(self.client.torrents_set_upload_limit, limit=self.throttle_limit,
+                             torrent_hashes=hashes)
+        for torrent_hash in hashes:
+            torrent = self.torrents.get(torrent_hash, {})
+            self.throttled[torrent_hash] = (torrent.get("up_limit", 0), torrent.get("upspeed", 0))
+
+    async def _restore(self, hashes: list = None):
+        """Undo _throttle for hashes (every throttled torrent by default). The torrents are forgotten before the
+        calls, if one fails they keep their tag and are restored by _recover after the next login"""
+        hashes = list(self.throttled) if hashes is None else hashes
+        if not hashes:
+            return
+        logging.info(f"Restoring {len(hashes)} torrents on qbittorrent {self.name}")
+        by_tag = {}
+        for torrent_hash in hashes:
+            by_tag.setdefault(self._tag(self.throttled.pop(torrent_hash)[0]), []).append(torrent_hash)
+        await self._undo(by_tag)
+
+    async def _undo(self, by_tag: dict):
+        """Restore the torrents of each throttle tag with one call per tag and take the tag off them, tags no
+        throttled torrent uses any more are deleted"""
+        for tag, hashes in by_tag.items():
+            if tag == f"{self.TAG_PREFIX}paused":
+                await self._call(self.client.torrents_resume, torrent_hashes=hashes)
+            else:
+                await self._call(self.client.torrents_set_upload_limit, limit=int(tag.rsplit(":", 1)[1]),
+                                 torrent_hashes=hashes)
+            await self._call(self.client.torrents_remove_tags, tags=tag, torrent_hashes=hashes)
+        in_use = {self._tag(limit) for limit, _ in self.throttled.values()}
+        unused = [tag for tag in by_tag if tag not in in_use]
+        if unused:
+            await self._call(self.client.torrents_delete_tags, tags=unused)
+
+    async def _recover(self):
+        """Restore the torrents that are tagged as throttled but that this run doesn't know about, they were left
+        behind by a run that couldn't restore them"""
+        by_tag = {}
+        for tag in await self._call(self.client.torrents_tags):
+            if not tag.startswith(self.TAG_PREFIX):
+                continue
+            torrents = await self._call(self.client.torrents_info, tag=tag)
+            hashes = [torrent["hash"] for torrent in torrents if torrent["hash"] not in self.throttled]
+            if hashes:
+                by_tag[tag] = hashes
+        if by_tag:
+            logging.warning(f"Restoring {sum(map(len, by_tag.values()))} torrents left throttled on qbittorrent "
+                            f"{self.name}")
+            await self._undo(by_tag)
+
+    async def _rebalance(self):
+        """Throttle the torrents that now upload the most and restore the ones they replaced"""
+        throttle, restore = self.plan_throttle()
+        await self._throttle(throttle)
+        await self._restore(restore)
+
+    async def set_rate_limit(self, rate_limit: bool) -> bool:
+        if not self.connected:
+            return False
+        try:
+            if self.throttle_mode == self.GLOBAL:
+                await self._call(self.client.transfer_set_speed_limits_mode, rate_limit)
+            elif rate_limit:
+                await self.sync()
+                await self._rebalance()
+            else:
+                await self._restore()
+        except Exception as e:
+            self._failed("set speed limit mode of", e)
+            return False
+        self.rate_limited = rate_limit
+        return True
+
+    async def refresh_throttle(self):
+        """While inhibiting, throttle torrents that started uploading faster than the throttled ones since
+        inhibiting started"""
+        if self.throttle_mode == self.GLOBAL or not self.rate_limited:
+            return
+        try:
+            await self._rebalance()
+        except Exception as e:
+            self._failed("throttle torrents on", e)
+
+    async def logout(self):
+        """Undo any per torrent throttling and log out, the torrents would otherwise stay paused or capped"""
+        if not self.connected:
+            if self.throttled:
+                logging.warning(f"qbittorrent {self.name} is not connected, {len(self.throttled)} torrents are left "
+                                f"throttled until the next login")
+            return
+        try:
+            await self._restore()
+        except Exception as e:
+            logging.error(f"Failed to restore the throttled torrents on qbittorrent {self.name}: {e}")
+        try:
+            await self._call(self.client.auth_log_out)
+        except Exception as e:
+            logging.error(f"Failed to log out of qbittorrent {self.name}: {e}")
+        self.connected = False
+
+    def close(self):
+        """Stop the instance's thread once its last call has finished, the instance can't be used afterwards"""
+        self._executor.shutdown(wait=False)
+
+    async def run(self, scheduler: Scheduler, desired_state):
+        """Health check the instance, desired_state is called to get the speed limit mode the instance should be in
+        so that an instance that (re)connects late is brought in line with the others"""
+        async def poll():
+            if not await self.check():
+                return
+            if self.rate_limited != desired_state():
+                await self.set_rate_limit(desired_state())
+            else:
+                await self.refresh_throttle()
+
+        await scheduler.every(f"qbt:{self.name}", poll, 5, jitter=1, cost=3)
+
+    def dump(self) -> dict:
+        return {"connected": self.connected, "rate_limited": self.rate_limited, "last_error": self.last_error,
+                "throttle_mode": self.throttle_mode, "throttled": len(self.throttled)}
@@ -0,0 +1,172 @@
+import asyncio
+import inspect
+import logging
+import time
+
+
+class Job:
+    """A periodic piece of work owned by the scheduler.
+    The callback may be a function or a coroutine function, if it returns a number that number becomes the new
+    interval (this is how detectors poll faster or slower depending on what they see)"""
+
+    def __init__(self, name: str, callback, interval: float, jitter: float = 0, cost: float = 1,
+                 wakeup: asyncio.Event = None):
+        self.name = name
+        self.callback = callback
+        self.interval = interval
+        self.jitter = jitter  # The job may run this many seconds early or late so that wakeups can be shared
+        self.cost = cost  # Relative cost of a run, cheap jobs are started first when several are due together
+
+        self.next_run = 0
+        self.last_run = None  # When the last run started
+        self.running = False
+        self.runs = 0
+        self.runtime = 0  # Total time spent in the callback
+        self.last_error = None
+        self._done = asyncio.get_event_loop().create_future()
+        self._wakeup = wakeup  # The scheduler's wakeup, set when a new interval moves the next run
+
+    def set_interval(self, interval: float):
+        """Change the interval, the next run moves to one new interval after the last run (right away if that has
+        already passed). A running job picks up the new interval when it finishes"""
+        self.interval = interval
+        if self.running or self.last_run is None:
+            return
+        self.next_run = self.last_run + interval
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def finish(self, exc: Exception = None):
+        if self._done.done():
+            return
+        if exc is None:
+            self._done.set_result(None)
+        else:
+            self._done.set_exception(exc)
+
+    @property
+    def finished(self) -> bool:
+        return self._done.done()
+
+    async def wait(self):
+        """Wait until the job is removed or the scheduler is shut down, raises if the callback raised"""
+        await asyncio.shield(self._done)
+
+    def dump(self) -> dict:
+        return {"interval": self.interval, "runs": self.runs,
+                "avg_runtime": self.runtime / self.runs if self.runs else 0, "last_error": self.last_error}
+
+
+class Scheduler:
+    """Runs all the periodic work from a single task, sleeping until the next job is due instead of every
+    component waking up on its own timer"""
+
+    def __init__(self):
+        self.jobs = {}
+        self.closed = False
+        self.wakeups = 0
+        self._wakeup = asyncio.Event()  # Set whenever the schedule changes so the runner recalculates its sleep
+        self._closed_event = asyncio.Event()
+        self._running = set()  # Job executions that are still in flight
+        self._task = None
+
+    def add(self, name: str, callback, interval: float, jitter: float = 0, cost: float = 1,
+            run_now: bool = True) -> Job:
+        """Register a periodic job, if run_now is False the first run happens after one interval"""
+        if self.closed:
+            raise RuntimeError("Scheduler is shut down")
+        if name in self.jobs:
+            raise ValueError(f"Job {name} is already scheduled")
+        job = Job(name, callback, interval, jitter, cost, self._wakeup)
+        job.next_run = time.monotonic() + (0 if run_now else interval)
+        self.jobs[name] = job
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self._run(), name="scheduler")
+        self._wakeup.set()
+        return job
+
+    def remove(self, job: Job):
+        if self.jobs.get(job.name) is job:
+            del self.jobs[job.name]
+        job.finish()
+
+    def run_now(self, name: str):
+        """Run a job at the next opportunity instead of waiting out its interval"""
+        job = self.jobs.get(name)
+        if job is None:
+            return
+        job.next_run = time.monotonic()
+        self._wakeup.set()
+
+    async def every(self, name: str, callback, interval: float, jitter: float = 0, cost: float = 1):
+        """Run callback periodically until the scheduler shuts down, meant to be the body of a supervised task"""
+        job = self.add(name, callback, interval, jitter, cost)
+        try:
+            await job.wait()
+        finally:
+            self.remove(job)
+
+    def shutdown(self):
+        """Stop running jobs and wake everything that is waiting on the scheduler"""
+        if self.closed:
+            return
+        self.closed = True
+        for execution in self._running:
+            execution.cancel()
+        for job in list(self.jobs.values()):
+            job.finish()
+        self._closed_event.set()
+        self._wakeup.set()
+
+    async def wait_closed(self):
+        await self._closed_event.wait()
+
+    async def _run(self):
+        while not self.closed:
+            now = time.monotonic()
+            due = [job for job in self.jobs.values()
+                   if not job.running and job.next_run - job.jitter <= now]
+            for job in sorted(due, key=lambda j: j.cost):
+                job.running = True
+                execution = asyncio.get_event_loop().create_task(self._execute(job), name=f"scheduler: {job.name}")
+                self._running.add(execution)
+                execution.add_done_callback(self._running.discard)
+
+            # Sleep until the latest point the most urgent job is allowed to run at, any job whose window has
+            # opened by then gets to share the wakeup
+            waiting = [job.next_run + job.jitter for job in self.jobs.values() if not job.running]
+            timeout = max(0, min(waiting) - time.monotonic()) if waiting else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeups += 1
+
+    async def _execute(self, job: Job):
+        started = time.monotonic()
+        job.last_run = started
+        try:
+            result = job.callback()
+            if inspect.isawaitable(result):
+                result = await result
+            if isinstance(result, (int, float)) and not isinstance(result, bool):
+                job.interval = result
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            job.last_error = f"{type(e).__name__}: {e}"
+            logging.error(f"Scheduled job {job.name} failed: {job.last_error}")
+            job.finish(e)
+            self.remove(job)
+        finally:
+            finished = time.monotonic()
+            job.runs += 1
+            job.runtime += finished - started
+            job.running = False
+            # Keep the job on its original cadence unless it fell behind
+            job.next_run = max(job.next_run + job.interval, finished)
+            self._wakeup.set()
+
+    def dump(self) -> dict:
+        return {"wakeups": self.wakeups, "jobs": {name: job.dump() for name, job in self.jobs.items()}}
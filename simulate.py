@@ -0,0 +1,209 @@
+import argparse
+import bisect
+import heapq
+import json
+import logging
+import types
+
+from detector import DetectorContext
+from helpers import APIInhibitor, InhibitHolder, NetInhibitor, PlexInhibitor, decide
+from net_detector import NetDetector
+from plex_detector import PlexDetector
+from supervisor import Supervisor
+
+""" Replays a recorded trace against the real detector and decision logic on a virtual clock.
+
+    Trace format, one json object per line, t is in seconds and only has to increase:
+        {"t": 0, "type": "plex", "sessions": [{"state": "playing", "address": "203.0.113.5"}]}
+            The sessions plex reports from t until the next plex line
+        {"t": 0, "type": "net", "bytes_sent": 123456}
+            The bytes_sent counter of the interface, the counter is interpolated between lines. A trace without net
+            lines is replayed without the net detector
+        {"t": 12.5, "type": "command", "inhibit": true, "override": true}
+            An api command, applied the same way the WebAPI applies it
+
+    Usage: python simulate.py trace.jsonl --threshold 0.5 --decision-interval 5
+"""
+
+
+class VirtualClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeQbt:
+    """Stands in for qbittorrent, records how long it was throttled and how often it was toggled"""
+
+    def __init__(self):
+        self.rate_limited = False
+        self.toggles = 0
+
+    def set_rate_limit(self, rate_limit: bool):
+        if rate_limit != self.rate_limited:
+            self.rate_limited = rate_limit
+            self.toggles += 1
+
+
+class TracePlexServer:
+    """Answers PlexDetector's sessions() calls from the plex lines of the trace"""
+
+    def __init__(self, clock: VirtualClock, snapshots: list):
+        self.clock = clock
+        self.times = [t for t, _ in snapshots]
+        self.sessions_at = [[types.SimpleNamespace(players=[types.SimpleNamespace(
+            state=session.get("state", "playing"), address=session.get("address", ""))])
+            for session in sessions] for _, sessions in snapshots]
+
+    def sessions(self):
+        index = bisect.bisect_right(self.times, self.clock()) - 1
+        return self.sessions_at[index] if index >= 0 else []
+
+
+class TraceCounter:
+    """Answers NetDetector's counter reads from the net lines of the trace"""
+
+    def __init__(self, clock: VirtualClock, samples: list):
+        self.clock = clock
+        self.times = [t for t, _ in samples]
+        self.values = [value for _, value in samples]
+
+    def __call__(self):
+        now = self.clock()
+        index = bisect.bisect_right(self.times, now)
+        if index == 0:
+            return self.values[0]
+        if index == len(self.times):
+            return self.values[-1]
+        t0, t1 = self.times[index - 1], self.times[index]
+        v0, v1 = self.values[index - 1], self.values[index]
+        return v0 + (v1 - v0) * (now - t0) / (t1 - t0)
+
+
+def load_trace(path: str) -> list:
+    with open(path) as trace_file:
+        events = [json.loads(line) for line in trace_file if line.strip()]
+    events.sort(key=lambda event: event["t"])
+    return events
+
+
+def simulate(events: list, threshold: float = 0.5, decision_interval: float = 5, net_interval: float = 5,
+             plex_active_interval: float = 5, plex_idle_interval: float = 15, plex_buffering_interval: float = 1,
+             local_subnets: list = ()) -> dict:
+    """Run the trace through the detectors and the decision logic and report how well the policy did"""
+    if not events:
+        raise ValueError("The trace is empty")
+    clock = VirtualClock()
+    start = events[0]["t"]
+    end = events[-1]["t"]
+    clock.now = start
+
+    context = DetectorContext(None, Supervisor())
+    holder = InhibitHolder()
+
+    plex_source = PlexInhibitor("plex")
+    plex = PlexDetector("plex", {"url": "trace", "token": ""}, plex_source, context)
+    plex_snapshots = [(event["t"], event.get("sessions", [])) for event in events if event["type"] == "plex"]
+    plex.plex_server = TracePlexServer(clock, plex_snapshots)
+    plex.local_subnets = list(local_subnets)
+    plex.active_interval, plex.idle_interval = plex_active_interval, plex_idle_interval
+    plex.buffering_interval = plex_buffering_interval
+
+    api_source = APIInhibitor("api")
+    holder.append(plex_source)
+    holder.append(api_source)
+
+    net_samples = [(event["t"], event["bytes_sent"]) for event in events if event["type"] == "net"]
+    net = None
+    if net_samples:
+        net_source = NetInhibitor("net")
+        net = NetDetector("net", {"threshold": threshold}, net_source, context)
+        net.clock = clock
+        net.read_bytes_sent = TraceCounter(clock, net_samples)
+        holder.append(net_source)
+    qbt = FakeQbt()
+
+    def remote_streams() -> int:
+        sessions = plex.plex_server.sessions()
+        return sum(1 for session in sessions if session.players[0].state in ("playing", "buffering") and
+                   not any(session.players[0].address.startswith(subnet) for subnet in plex.local_subnets))
+
+    def poll_plex():
+        return plex._update(plex._get_activity())
+
+    def poll_net():
+        net._sample()
+        return net_interval
+
+    def run_decision():
+        should_inhibit, _, _, _ = decide(holder.snapshot())
+        qbt.set_rate_limit(should_inhibit)
+        return decision_interval
+
+    # Virtual time event queue, the jobs reschedule themselves with the interval they return like they do with the
+    # real scheduler. The trace lines are queued as well so that the stream time is integrated exactly
+    queue = []
+    counter = 0
+
+    def push(at, kind, payload=None):
+        nonlocal counter
+        heapq.heappush(queue, (at, counter, kind, payload))
+        counter += 1
+
+    for event in events:
+        push(event["t"], event["type"], event)
+    push(start, "job", poll_plex)
+    if net is not None:
+        push(start, "job", poll_net)
+    push(start, "job", run_decision)
+
+    report = {"duration": end - start, "throttle_seconds": 0.0, "stream_seconds": 0.0,
+              "unprotected_stream_seconds": 0.0, "toggles": 0, "polls": 0}
+    streams = remote_streams()
+    while queue and queue[0][0] <= end:
+        at, _, kind, payload = heapq.heappop(queue)
+        elapsed = at - clock.now
+        if qbt.rate_limited:
+            report["throttle_seconds"] += elapsed
+        if streams:
+            report["stream_seconds"] += elapsed
+            if not qbt.rate_limited:
+                report["unprotected_stream_seconds"] += elapsed
+        clock.now = at
+
+        if kind == "job":
+            report["polls"] += 1
+            push(at + payload(), "job", payload)
+        elif kind == "command":
+            api_source.should_inhibit = payload["inhibit"]
+        streams = remote_streams()
+
+    report["toggles"] = qbt.toggles
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a trace against the inhibitor's decision logic")
+    parser.add_argument("trace", help="Trace file, see the top of simulate.py for the format")
+    parser.add_argument("--threshold", type=float, default=0.5, help="Net detector threshold in mbit/s")
+    parser.add_argument("--decision-interval", type=float, default=5)
+    parser.add_argument("--net-interval", type=float, default=5)
+    parser.add_argument("--plex-active-interval", type=float, default=5)
+    parser.add_argument("--plex-idle-interval", type=float, default=15)
+    parser.add_argument("--plex-buffering-interval", type=float, default=1)
+    parser.add_argument("--local-subnet", action="append", default=[],
+                        help="/24 prefix (for example 192.168.1) whose players don't count as remote")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    report = simulate(load_trace(args.trace), threshold=args.threshold, decision_interval=args.decision_interval,
+                      net_interval=args.net_interval, plex_active_interval=args.plex_active_interval,
+                      plex_idle_interval=args.plex_idle_interval,
+                      plex_buffering_interval=args.plex_buffering_interval, local_subnets=args.local_subnet)
+    print(json.dumps(report, indent=4))
+
+
+if __name__ == "__main__":
+    main()
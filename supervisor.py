@@ -0,0 +1,253 @@
+import asyncio
+import logging
+import random
+import time
+
+
+class RestartPolicy:
+    """Describes how the supervisor should treat a task once it has exited"""
+
+    ALWAYS = "always"  # Restart the task no matter how it exited
+    ON_FAILURE = "on_failure"  # Only restart the task if it raised an exception
+    NEVER = "never"  # Never restart the task
+
+    def __init__(self, restart: str = ALWAYS, max_restarts: int = None, base_delay: float = 1,
+                 max_delay: float = 300, jitter: float = 0.5, reset_after: float = 120):
+        self.restart = restart
+        self.max_restarts = max_restarts  # None means the task can be restarted forever
+        self.base_delay = base_delay  # The delay before the first restart
+        self.max_delay = max_delay  # The delay will never grow larger than this
+        self.jitter = jitter  # Fraction of the delay that is randomised so restarts don't line up
+        self.reset_after = reset_after  # If a task ran for this long the backoff starts over
+
+    def should_restart(self, failed: bool, restarts: int) -> bool:
+        if self.restart == self.NEVER:
+            return False
+        if self.restart == self.ON_FAILURE and not failed:
+            return False
+        if self.max_restarts is not None and restarts >= self.max_restarts:
+            return False
+        return True
+
+    def delay(self, attempt: int) -> float:
+        """Exponential backoff with jitter, attempt 0 is the first restart"""
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        return delay * (1 - self.jitter * random.random())
+
+
+class CircuitBreaker:
+    """Guards an upstream service (qbittorrent, plex), once it has failed enough times in a row calls to it are
+    refused until a cool-down has passed, the cool-down doubles every time the breaker trips again"""
+
+    CLOSED = "closed"  # Everything is fine, calls are allowed
+    OPEN = "open"  # The upstream is failing, calls are refused
+    HALF_OPEN = "half_open"  # The cool-down has passed, a single trial call is allowed
+
+    def __init__(self, name: str, failure_threshold: int = 3, reset_timeout: float = 10,
+                 max_reset_timeout: float = 600, jitter: float = 0.2):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.jitter = jitter
+
+        self._state = self.CLOSED
+        self.failures = 0  # Consecutive failures
+        self.trips = 0  # Consecutive times the breaker has opened without a success in between
+        self.total_trips = 0
+        self.opened_at = 0
+        self.open_for = 0
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self.opened_at >= self.open_for:
+            self._state = self.HALF_OPEN
+        return self._state
+
+    def allow(self) -> bool:
+        """Returns True if a call to the upstream should be attempted"""
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN:
+            # Only let one trial call through, it will either close or re-open the breaker
+            self._state = self.OPEN
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+    def record_success(self):
+        if self._state != self.CLOSED:
+            logging.info(f"Circuit breaker {self.name} closed")
+        self._state = self.CLOSED
+        self.failures = 0
+        self.trips = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold or self._state != self.CLOSED:
+            self._trip()
+
+    def _trip(self):
+        timeout = min(self.max_reset_timeout, self.reset_timeout * (2 ** self.trips))
+        self.open_for = timeout * (1 - self.jitter * random.random())
+        self.opened_at = time.monotonic()
+        self._state = self.OPEN
+        self.trips += 1
+        self.total_trips += 1
+        logging.warning(f"Circuit breaker {self.name} opened for {self.open_for:.1f} seconds "
+                        f"after {self.failures} failures")
+
+    def dump(self) -> dict:
+        return {"state": self.state, "failures": self.failures, "trips": self.total_trips}
+
+
+class SupervisedTask:
+    """A single task owned by the supervisor"""
+
+    def __init__(self, name: str, factory, policy: RestartPolicy):
+        self.name = name
+        self.factory = factory  # Callable that builds a fresh coroutine every time the task is (re)started
+        self.policy = policy
+        self.task = None
+        self.restarts = 0  # Total number of restarts
+        self.attempt = 0  # Restarts since the task last ran for longer than policy.reset_after
+        self.started_at = 0
+        self.last_error = None
+        self.state = "stopped"
+        self.cancelling = False  # Set while restart() or remove() stops the task, it must not be rescheduled
+
+    def dump(self) -> dict:
+        return {"state": self.state, "restarts": self.restarts, "last_error": self.last_error}
+
+
+class Supervisor:
+    """Starts tasks, restarts them according to their restart policy and keeps the circuit breakers for the
+    upstream services so that their state survives a task restart"""
+
+    def __init__(self):
+        self.children = {}
+        self.breakers = {}
+        self.stopping = False
+        self._pending = {}  # Tasks that are waiting out their backoff before restarting
+
+    def breaker(self, name: str, **kwargs) -> CircuitBreaker:
+        """Get the circuit breaker for an upstream, creating it if it doesn't exist yet"""
+        if name not in self.breakers:
+            self.breakers[name] = CircuitBreaker(name, **kwargs)
+        return self.breakers[name]
+
+    def add(self, name: str, factory, policy: RestartPolicy = None):
+        """Register and start a task, factory is called with no arguments and must return a coroutine"""
+        if name in self.children:
+            raise ValueError(f"Task {name} is already supervised")
+        child = SupervisedTask(name, factory, policy or RestartPolicy())
+        self.children[name] = child
+        self._start(child)
+        return child
+
+    def _start(self, child: SupervisedTask):
+        child.started_at = time.monotonic()
+        child.state = "running"
+        child.task = asyncio.get_event_loop().create_task(child.factory(), name=child.name)
+        child.task.add_done_callback(lambda task: self._on_done(child, task))
+
+    def _on_done(self, child: SupervisedTask, task: asyncio.Task):
+        if task is not child.task:
+            return
+        failed = False
+        if task.cancelled():
+            child.state = "cancelled"
+        elif task.exception() is not None:
+            failed = True
+            child.state = "failed"
+            exc = task.exception()
+            child.last_error = f"{type(exc).__name__}: {exc}"
+            logging.error(f"Task {child.name} failed: {child.last_error}", exc_info=exc)
+        else:
+            child.state = "exited"
+
+        if self.stopping or child.cancelling or task.cancelled():
+            logging.info(f"Task {child.name} stopped, not restarting")
+            return
+        self._schedule_restart(child, failed)
+
+    def _schedule_restart(self, child: SupervisedTask, failed: bool):
+        """Restart the task after its backoff if its restart policy allows it"""
+        if not child.policy.should_restart(failed, child.restarts):
+            logging.warning(f"Task {child.name} {child.state}, restart policy says not to restart it")
+            return
+
+        if time.monotonic() - child.started_at >= child.policy.reset_after:
+            child.attempt = 0
+        delay = child.policy.delay(child.attempt)
+        child.attempt += 1
+        child.state = "backoff"
+        logging.info(f"Restarting task {child.name} in {delay:.1f} seconds (restart {child.restarts + 1})")
+        self._pending[child.name] = asyncio.get_event_loop().call_later(delay, self._restart, child)
+
+    def _restart(self, child: SupervisedTask):
+        self._pending.pop(child.name, None)
+        if self.stopping:
+            return
+        child.restarts += 1
+        try:
+            self._start(child)
+        except Exception as e:
+            # The factory itself failed, treat it the same way as the task failing
+            child.state = "failed"
+            child.last_error = f"{type(e).__name__}: {e}"
+            logging.error(f"Failed to restart task {child.name}: {child.last_error}", exc_info=True)
+            self._schedule_restart(child, True)
+
+    async def _cancel(self, child: SupervisedTask):
+        handle = self._pending.pop(child.name, None)
+        if handle is not None:
+            handle.cancel()
+        if child.task is not None and not child.task.done():
+            # A task can swallow the cancellation and exit normally, the flag keeps _on_done from scheduling a
+            # restart of its own in that case
+            child.cancelling = True
+            try:
+                child.task.cancel()
+                await asyncio.gather(child.task, return_exceptions=True)
+            finally:
+                child.cancelling = False
+
+    async def remove(self, name: str):
+        """Stop a task and forget about it"""
+        child = self.children.pop(name, None)
+        if child is None:
+            return
+        logging.info(f"Removing task {name}")
+        await self._cancel(child)
+
+    async def restart(self, name: str):
+        """Restart a task right away, used when its configuration changed"""
+        child = self.children[name]
+        logging.info(f"Restarting task {name}")
+        await self._cancel(child)
+        if not self.stopping:
+            self._start(child)
+
+    def tasks(self):
+        return [child.task for child in self.children.values() if child.task is not None]
+
+    async def stop(self, timeout: float = 5):
+        """Stop restarting tasks and wait for the running ones to finish, cancelling them if they take too long"""
+        self.stopping = True
+        for handle in self._pending.values():
+            handle.cancel()
+        self._pending.clear()
+        tasks = self.tasks()
+        if not tasks:
+            return
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def dump(self) -> dict:
+        """Restart counts and breaker states, sent to the api clients"""
+        return {"tasks": {name: child.dump() for name, child in self.children.items()},
+                "breakers": {name: breaker.dump() for name, breaker in self.breakers.items()}}
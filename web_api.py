@@ -3,11 +3,12 @@ import ctypes
 import logging
 import json
 from asyncio import StreamReader, StreamWriter
+import time
 import uuid
 
 from helpers import InhibitSource, WebInhibitor, APIInhibitor, APIMessageRX, APIMessageTX
-
-logging.getLogger(__name__).setLevel(logging.DEBUG)
+from scheduler import Scheduler
+from supervisor import RestartPolicy
 
 handshake_message = json.dumps({"server": "Test", "type": "handshake"}).encode("utf-8")
 
@@ -20,13 +21,50 @@ handshake_message = json.dumps({"server": "Test", "type": "handshake"}).encode("
 """
 
 
+class TokenBucket:
+    """Allows rate messages per second on average with bursts of up to burst messages"""
+
+    def __init__(self, rate: float, burst: int, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+
+    def take(self) -> float:
+        """Take a token, returns 0 if one was available or how many seconds to wait until there is one"""
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
 class WebAPI:
 
-    def __init__(self, address: str, main_port: int, alt_port: int, interface_class: APIInhibitor):
+    restart_policy = RestartPolicy(base_delay=1, max_delay=60)
+
+    def __init__(self, address: str, main_port: int, alt_port: int, interface_class: APIInhibitor,
+                 scheduler: Scheduler, message_rate: float = 5, message_burst: int = 10,
+                 coalesce_window: float = 0.25):
         self.address = address
         self.main_port = main_port
         self.alt_port = alt_port
         self.interface_class = interface_class
+        self.scheduler = scheduler  # Runs the decision job after a command, the server runs until it shuts down
+        self.server = None  # The listening server, None while not bound
+
+        self.message_rate = message_rate  # Messages per second each connection may send on average
+        self.message_burst = message_burst
+        # Commands arriving within this many seconds of an applied command are merged into one change
+        self.coalesce_window = coalesce_window
+        self.command_seq = 0  # Sequence number of the last command received
+        self._pending_command = None  # The latest command received since the last change was applied
+        self._command_waiters = []  # (connection, seq, request_id) of the commands merged into the pending one
+        self._window = None  # Handle closing the current coalescing window
+        self._ack_tasks = set()  # Keeps the command_ack tasks referenced until they finish
 
         self.refresh_task = asyncio.create_task(self._on_inhibit_state_update(self.interface_class.inhibit_event),
                                                 name="WebAPI: Background refresh")
@@ -38,28 +76,67 @@ class WebAPI:
     def get_source(self) -> InhibitSource:
         return self.interface_class
 
-    async def __aenter__(self):
-        """Bind to the address and port, and start listening for connections"""
+    def _state_message(self) -> APIMessageTX:
+        """Build a state_update message from the shared state, the state is immutable so no copy is needed"""
+        state = self.interface_class.system_state
+        return APIMessageTX(
+            msg_type="state_update",
+            inhibiting=state.inhibiting,
+            inhibited_by=state.inhibited_by,
+            overridden=state.overridden,
+            qbt_connection=state.qbt_connection,
+            qbt_instances=state.qbt_instances,
+            plex_connection=state.plex_connection,
+            net_connection=state.net_connection,
+            detectors=state.detectors,
+            services=dict(state.services, **(self.interface_class.service_stats() if
+                                             self.interface_class.service_stats else {})),
+            message=state.message,
+            state_version=self.interface_class.state_version,
+            version=self.interface_class.version)
+
+    async def _bind(self):
         logging.info(f"Starting web api server on http://{self.address}:{self.main_port}")
         try:
-            self.server = await asyncio.start_server(self._on_connection, self.address, self.main_port)
+            server = await asyncio.start_server(self._on_connection, self.address, self.main_port)
         except OSError as e:
             try:
                 logging.error(f"Failed to start web api server on http://{self.address}:{self.alt_port}\n{e}")
-                self.server = await asyncio.start_server(self._on_connection, self.address, self.alt_port)
+                server = await asyncio.start_server(self._on_connection, self.address, self.alt_port)
             except Exception as e:
                 logging.error(f"Failed to start web api server on http://{self.address}:{self.alt_port}\n{e}")
                 raise e
         logging.info(f"Web api server started on http://{self.address}:{self.main_port}")
+        return server
+
+    async def __aenter__(self):
+        """Bind to the address and port, and start listening for connections"""
+        self.server = await self._bind()
         return self.server
 
+    async def rebind(self, address: str, main_port: int, alt_port: int):
+        """Move the listening socket to a new address, the connections that are already open are kept along with
+        the source and the broadcaster. If the new address can't be bound the old one keeps serving"""
+        previous = (self.address, self.main_port, self.alt_port)
+        self.address, self.main_port, self.alt_port = address, main_port, alt_port
+        try:
+            server = await self._bind()
+        except Exception:
+            self.address, self.main_port, self.alt_port = previous
+            raise
+        old_server, self.server = self.server, server
+        old_server.close()  # Only stops accepting, the open connections belong to their listeners
+
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         """Stop the server"""
         logging.info("Stopping web api server")
+        self.refresh_task.cancel()
+        if self._window is not None:
+            self._window.cancel()
         self.server.close()
         await self.server.wait_closed()
+        self.server = None
         logging.info("Web api server stopped")
-        return self
 
     async def _on_connection(self, reader: StreamReader, writer: StreamWriter):
         """When a new connection is made, add it to the list of connections, and send a handshake message"""
@@ -98,31 +175,28 @@ class WebAPI:
             conn_data = self.connections[conn_uuid]
         logging.info(f"Listener started for {conn_uuid}")
         reader, writer, lock = conn_data["reader"], conn_data["writer"], conn_data["lock"]
+        bucket = conn_data["bucket"]
         while not self.interface_class.shutdown:
             try:
                 new_message = str(await reader.readuntil(b'\n\r'), 'utf-8')
+                wait = bucket.take()
+                if wait:
+                    # Stop reading from the client until it is back under its rate, anything it sends in the
+                    # meantime waits in the socket buffer
+                    logging.warning(f"Connection {conn_uuid} is sending too many messages, slowing it down")
+                    await asyncio.sleep(wait)
+                    bucket.take()
                 msg = APIMessageRX(new_message)
                 if msg.msg_type == "command":
                     logging.info(f"Received command {msg}")
-                    self.interface_class.should_inhibit = msg.inhibit
-                    self.interface_class.overridden = msg.override
-                    self.interface_class.inhibit_event.set()
+                    self._on_command(conn_uuid, msg)
                 elif msg.msg_type == "ack":
                     """A client sends this message to acknowledge that it has received the last message"""
                     pass
                 elif msg.msg_type == "refresh":
                     """A client sends this message when it wants to get a fresh copy of the current state"""
-                    api_message = APIMessageTX(
-                        msg_type="state_update",
-                        inhibiting=self.interface_class.inhibiting,
-                        inhibited_by=self.interface_class.inhibited_by,
-                        overridden=self.interface_class.overridden,
-                        qbt_connection=self.interface_class.qbt_connection,
-                        plex_connection=self.interface_class.plex_connection,
-                        net_connection=self.interface_class.net_connection,
-                        message=self.interface_class.message,
-                        version=self.interface_class.version)
-                    logging.debug(f"Acquiring lock for {writer.get_extra_info('peername')}, {lock}")
+                    api_message = self._state_message()
+                    logging.debug("Acquiring lock for %s, %s", writer.get_extra_info('peername'), lock)
                     async with lock:
                         writer.write(api_message.encode('utf-8'))
                         await writer.drain()
@@ -149,6 +223,21 @@ class WebAPI:
                         await self.interface_class.service_update_response(True)
                     elif msg.command == "deny_update":
                         await self.interface_class.service_update_response(False)
+                elif msg.msg_type == "history":
+                    """A client sends this message to get the aggregated history between start and end (unix time),
+                    optionally split into buckets of bucket seconds"""
+                    try:
+                        result = await self.interface_class.service_history_query(
+                            msg.start, msg.end, getattr(msg, "bucket", None))
+                        api_message = APIMessageTX(msg_type="history", request_id=getattr(msg, "request_id", None),
+                                                   **result)
+                    except Exception as e:
+                        logging.error(f"Failed to query history: {e}")
+                        api_message = APIMessageTX(msg_type="history", request_id=getattr(msg, "request_id", None),
+                                                   error=str(e))
+                    async with lock:
+                        writer.write(api_message.encode('utf-8'))
+                        await writer.drain()
                 else:
                     logging.warning(f"Unknown message type {msg.msg_type}")
 
@@ -167,12 +256,59 @@ class WebAPI:
         logging.warning(f"Listener stopped for {conn_uuid}")
         await self._on_disconnect(token=conn_uuid)
 
+    def _on_command(self, conn_uuid: str, msg: APIMessageRX):
+        """Override commands are merged: the first one is applied right away and opens a coalescing window, the
+        commands that arrive during the window only replace the pending command, which is applied when the window
+        closes. Every command is acknowledged with the sequence number of the change that applied it"""
+        self.command_seq += 1
+        self._pending_command = (msg.inhibit, msg.override)
+        self._command_waiters.append((conn_uuid, self.command_seq, getattr(msg, "request_id", None)))
+        if self._window is None:
+            self._apply_command()
+
+    def _apply_command(self):
+        if self._pending_command is None:
+            self._window = None  # Nothing arrived during the window, the next command is applied right away
+            return
+        inhibit, override = self._pending_command
+        waiters, self._command_waiters = self._command_waiters, []
+        self._pending_command = None
+        # Only inhibit is applied, override is acknowledged but the api source never overrides the other sources
+        if inhibit != self.interface_class.should_inhibit:
+            self.interface_class.should_inhibit = inhibit
+            self.interface_class.inhibit_event.set()
+            # Decide right away instead of at the next tick, the ack tells the client the change was applied
+            self.scheduler.run_now("decision")
+        if len(waiters) > 1:
+            logging.info(f"Merged {len(waiters)} commands into one, inhibit={inhibit} override={override}")
+        self._window = asyncio.get_event_loop().call_later(self.coalesce_window, self._apply_command)
+        task = asyncio.create_task(self._ack_commands(waiters, inhibit, override), name="WebAPI: Command ack")
+        self._ack_tasks.add(task)
+        task.add_done_callback(self._ack_tasks.discard)
+
+    async def _ack_commands(self, waiters: list, inhibit: bool, override: bool):
+        applied_seq = waiters[-1][1]
+        for conn_uuid, seq, request_id in waiters:
+            connection = self.connections.get(conn_uuid)
+            if connection is None:
+                continue  # Disconnected in the meantime
+            api_message = APIMessageTX(msg_type="command_ack", seq=seq, applied_seq=applied_seq,
+                                       request_id=request_id, inhibit=inhibit, override=override,
+                                       coalesced=len(waiters))
+            try:
+                async with connection["lock"]:
+                    connection["writer"].write(api_message.encode('utf-8'))
+                    await connection["writer"].drain()
+            except OSError as e:
+                logging.warning(f"Failed to acknowledge command to {conn_uuid}: {e}")
+
     async def _on_new(self, reader: StreamReader, writer: StreamWriter) -> str:
         """Called when a new connection is made"""
         token = uuid.uuid4().hex
         lock = asyncio.Lock()
         async with self.connections_lock:
-            self.connections.update({token: {"reader": reader, "writer": writer, "lock": lock}})
+            self.connections.update({token: {"reader": reader, "writer": writer, "lock": lock,
+                                             "bucket": TokenBucket(self.message_rate, self.message_burst)}})
         logging.debug(f"Added connection {token} to list from {writer.get_extra_info('peername')}")
         api_message = APIMessageTX(
             msg_type="new_conn",
@@ -218,16 +354,7 @@ class WebAPI:
                 await event.wait()
                 logging.debug(f"Updating all connections with new inhibit state")
 
-                api_message = APIMessageTX(
-                    msg_type="state_update",
-                    inhibiting=self.interface_class.inhibiting,
-                    inhibited_by=self.interface_class.inhibited_by,
-                    overridden=self.interface_class.overridden,
-                    qbt_connection=self.interface_class.qbt_connection,
-                    plex_connection=self.interface_class.plex_connection,
-                    net_connection=self.interface_class.net_connection,
-                    message=self.interface_class.message,
-                    version=self.interface_class.version)
+                api_message = self._state_message()
 
                 async with self.connections_lock:  # Acquire lock on the connections list to prevent concurrent access
                     for token, connection in self.connections.items():
@@ -248,14 +375,13 @@ class WebAPI:
     async def run(self):
         try:
             async with self as serv:
-                while not self.interface_class.shutdown:
-                    await asyncio.sleep(1)
+                await self.scheduler.wait_closed()  # Nothing to do periodically, just serve until shutdown
                 serv.close()
         except Exception as e:
             logging.error(f"Error in server: {e}")
             raise e
 
-    def _on_refresh_task_done(self):
+    def _on_refresh_task_done(self, task: asyncio.Task):
         logging.info("Refresh task finished")
         pass
 